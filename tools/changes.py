@@ -0,0 +1,222 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import datetime
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+
+# The number of individual change sets published; older change sets are folded into a single compacted change set.
+MAXIMUM_CHANGE_SETS = 30
+
+SNAPSHOT_FILENAME = "snapshot.json"
+INDEX_FILENAME = "index.json"
+
+CATEGORIES = ["programs", "releases"]
+
+
+def digest(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def release_key(release):
+    return "\t".join([release['uid'], release['sha256'], "/".join(item['name'] for item in release['reference'])])
+
+
+def identifier_key(identifier):
+    return "\t".join([identifier['uid'], identifier['sha256'], identifier['path']])
+
+
+def release_identifier(key):
+    uid, sha256, path = key.split("\t")
+    return {
+        'uid': uid,
+        'sha256': sha256,
+        'path': path,
+    }
+
+
+class Snapshot(object):
+    """
+    Digest of every program and release in the index, used to determine what changed between builds. Programs are
+    added one at a time, allowing the index to be streamed.
+    """
+
+    def __init__(self):
+        self.programs = {}
+        self.releases = {}
+
+    def add(self, program):
+        for version in program['versions']:
+            for variant in version['variants']:
+                for release in variant['items']:
+                    self.releases[release_key(release)] = digest(release)
+        self.programs[program['uid']] = digest(program)
+
+    def as_dict(self):
+        return {
+            'programs': self.programs,
+            'releases': self.releases,
+        }
+
+
+def snapshot(programs):
+    current_snapshot = Snapshot()
+    for program in programs:
+        current_snapshot.add(program)
+    return current_snapshot.as_dict()
+
+
+def diff(old, new):
+    return {
+        'added': sorted(key for key in new if key not in old),
+        'modified': sorted(key for key in new if key in old and new[key] != old[key]),
+        'removed': sorted(key for key in old if key not in new),
+    }
+
+
+def merge(older, newer):
+    # Combine two consecutive sets of changes (as returned by `diff`) into one.
+    states = {}
+    for state in ['added', 'modified', 'removed']:
+        for key in older[state]:
+            states[key] = state
+    for state in ['added', 'modified', 'removed']:
+        for key in newer[state]:
+            previous = states.get(key)
+            if previous == 'added' and state == 'modified':
+                continue
+            elif previous == 'added' and state == 'removed':
+                del states[key]
+            elif previous == 'removed' and state == 'added':
+                states[key] = 'modified'
+            else:
+                states[key] = state
+    return {state: sorted(key for key, value in states.items() if value == state)
+            for state in ['added', 'modified', 'removed']}
+
+
+def write_json(path, value):
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w") as fh:
+        json.dump(value, fh)
+    os.replace(temporary_path, path)
+
+
+class ChangeLog(object):
+    """
+    Persistent log of the changes between successive builds of the index, stored in `path`. Each build is assigned a
+    monotonically increasing identifier, and a change set listing the programs and releases added, modified, or removed
+    since the previous build.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = os.path.join(path, INDEX_FILENAME)
+        self.snapshot_path = os.path.join(path, SNAPSHOT_FILENAME)
+        try:
+            with open(self.index_path) as fh:
+                self.index = json.load(fh)
+        except FileNotFoundError:
+            self.index = {
+                'latest': 0,
+                'changes': [],
+            }
+
+    def _load_change_set(self, entry):
+        with open(os.path.join(self.path, entry['path'])) as fh:
+            return json.load(fh)
+
+    def _write_change_set(self, change_set):
+        if change_set['from'] + 1 == change_set['id']:
+            filename = f"{change_set['id']}.json"
+        else:
+            filename = f"{change_set['from']}-{change_set['id']}.json"
+        write_json(os.path.join(self.path, filename), change_set)
+        return {
+            'id': change_set['id'],
+            'from': change_set['from'],
+            'timestamp': change_set['timestamp'],
+            'path': filename,
+        }
+
+    def record(self, current_snapshot):
+        """
+        Record a build of the index with `current_snapshot`, a `Snapshot` of its programs.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        try:
+            with open(self.snapshot_path) as fh:
+                previous_snapshot = json.load(fh)
+        except FileNotFoundError:
+            previous_snapshot = {category: {} for category in CATEGORIES}
+        current_snapshot = current_snapshot.as_dict()
+
+        build_id = self.index['latest'] + 1
+        changes = {category: diff(previous_snapshot[category], current_snapshot[category]) for category in CATEGORIES}
+        change_set = {
+            'id': build_id,
+            'from': self.index['latest'],
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'programs': changes['programs'],
+            'releases': {state: [release_identifier(key) for key in keys]
+                         for state, keys in changes['releases'].items()},
+        }
+        logging.info("Recording build %d (%s)...", build_id, ", ".join(
+            f"{len(change_set['programs'][state])} programs {state}" for state in ['added', 'modified', 'removed']))
+        self.index['changes'].append(self._write_change_set(change_set))
+        self.index['latest'] = build_id
+        self.compact()
+
+        # The snapshot is written last; if we fail before this point, the next build will simply report some of the
+        # same changes again.
+        write_json(self.index_path, self.index)
+        write_json(self.snapshot_path, current_snapshot)
+        return change_set
+
+    def compact(self):
+        # Fold the oldest change sets into a single change set until we're within our limit (allowing for the
+        # compacted change set itself).
+        while len(self.index['changes']) > MAXIMUM_CHANGE_SETS + 1:
+            older_entry, newer_entry = self.index['changes'][:2]
+            older = self._load_change_set(older_entry)
+            newer = self._load_change_set(newer_entry)
+            releases = merge({state: [identifier_key(release) for release in older['releases'][state]]
+                              for state in older['releases']},
+                             {state: [identifier_key(release) for release in newer['releases'][state]]
+                              for state in newer['releases']})
+            compacted = {
+                'id': newer['id'],
+                'from': older['from'],
+                'timestamp': newer['timestamp'],
+                'programs': merge(older['programs'], newer['programs']),
+                'releases': {state: [release_identifier(key) for key in keys] for state, keys in releases.items()},
+            }
+            self.index['changes'][:2] = [self._write_change_set(compacted)]
+            for entry in [older_entry, newer_entry]:
+                os.remove(os.path.join(self.path, entry['path']))
+
+    def publish(self, destination_path):
+        if os.path.exists(destination_path):
+            shutil.rmtree(destination_path)
+        shutil.copytree(self.path, destination_path, ignore=shutil.ignore_patterns(SNAPSHOT_FILENAME, "*.tmp"))
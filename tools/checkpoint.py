@@ -0,0 +1,144 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import logging
+import os
+import time
+
+
+# Records are flushed immediately, but only fsync'd in batches to avoid paying for a sync per asset.
+SYNC_RECORD_COUNT = 64
+SYNC_INTERVAL = 5.0
+
+
+class ReleaseLog(object):
+    """
+    Append-only JSON lines log of the assets imported during an index, and the releases found in each, with markers
+    recording the completion of each source. This allows an interrupted index to be resumed, or the index outputs to be
+    regenerated, without re-analysing any assets.
+
+    Releases are loaded as `(ordinal, record)` tuples where `ordinal` is the position of the asset in its source's walk,
+    allowing the logs of several shards to be merged in single-machine order. A later record for an asset supersedes any
+    earlier one, keeping its position, which allows selected assets to be re-imported into an existing log.
+    """
+
+    def __init__(self, path, resume=False, read_only=False):
+        self.path = path
+        self.sources = set()
+        self._assets = {}
+        self._fh = None
+        if resume or read_only:
+            self._load()
+        if read_only:
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._fh = open(path, "a" if resume else "w", encoding="utf-8")
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        valid_length = 0
+        with open(self.path, "rb") as fh:
+            for line in fh:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.warning("Ignoring incomplete records at the end of '%s'.", self.path)
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                valid_length += len(line)
+                if record['type'] == 'asset':
+                    self._assets[(record['source'], record['asset'])] = (record['ordinal'], record['releases'])
+                elif record['type'] == 'source':
+                    self.sources.add(record['source'])
+
+        # Discard any partially written record so that new records start on a fresh line.
+        if valid_length != os.path.getsize(self.path):
+            os.truncate(self.path, valid_length)
+        logging.info("Loaded %d releases from %d assets in '%s'.", len(self.releases), len(self._assets), self.path)
+
+    def _write(self, record, sync=False):
+        self._fh.write(json.dumps(record) + "\n")
+        self._fh.flush()
+        self._pending += 1
+        if sync or self._pending >= SYNC_RECORD_COUNT or time.monotonic() - self._last_sync >= SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        if self._fh is None or self._pending == 0:
+            return
+        os.fsync(self._fh.fileno())
+        self._pending = 0
+        self._last_sync = time.monotonic()
+
+    @property
+    def releases(self):
+        return [(ordinal, release) for ordinal, releases in self._assets.values() for release in releases]
+
+    def releases_for(self, source):
+        return [(ordinal, release)
+                for (asset_source, _), (ordinal, releases) in self._assets.items() if asset_source == source
+                for release in releases]
+
+    def records_for(self, source, asset):
+        """
+        Return the releases most recently recorded for `asset`, or an empty list if it hasn't been imported.
+        """
+        return self._assets.get((source, asset), (None, []))[1]
+
+    def contains(self, source, asset):
+        return (source, asset) in self._assets
+
+    def is_complete(self, source):
+        return source in self.sources
+
+    def add_asset(self, source, asset, ordinal, releases):
+        self._assets[(source, asset)] = (ordinal, releases)
+        self._write({
+            'type': 'asset',
+            'source': source,
+            'asset': asset,
+            'ordinal': ordinal,
+            'releases': releases,
+        })
+
+    def complete(self, source):
+        self.sources.add(source)
+        self._write({
+            'type': 'source',
+            'source': source,
+        }, sync=True)
+
+    def close(self):
+        if self._fh is None:
+            return
+        self.sync()
+        self._fh.close()
+        self._fh = None
@@ -20,10 +20,14 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import concurrent.futures
+import hashlib
+import json
 import logging
 import os
 
 from urllib.parse import quote_plus
+from urllib.parse import unquote
 from urllib.parse import urlparse
 
 import yaml
@@ -39,6 +43,16 @@ class UnsupportedURL(Exception):
     pass
 
 
+class IntegrityError(Exception):
+    pass
+
+
+# Number of sources synced concurrently when pipelining sync and index.
+SYNC_JOBS = 2
+
+# Hours between conditional requests revalidating previously downloaded metadata and assets.
+REFRESH_INTERVAL = 24
+
 ARCHIVE_EXTENSIONS = set([
     ".zip",
     ".iso",
@@ -60,19 +74,154 @@ class Library(object):
             logging.warning("Using $INDEXER_ASSETS_DIRECTORY environment variable (%s)", self.assets_directory)
         self.index_directory = os.path.normpath(os.path.join(root_directory, self._configuration['index_directory']))
         self.output_directory = os.path.normpath(os.path.join(root_directory, self._configuration['output_directory']))
-        self.sources = [InternetArchiveSource(self.assets_directory, url)
-                        for url in self._configuration['sources']]
+        self.state_directory = os.path.normpath(os.path.join(root_directory,
+                                                             self._configuration.get('state_directory', '../_state')))
+        if "INDEXER_STATE_DIRECTORY" in os.environ:
+            self.state_directory = os.environ["INDEXER_STATE_DIRECTORY"]
+            logging.warning("Using $INDEXER_STATE_DIRECTORY environment variable (%s)", self.state_directory)
+        self.mirror_directory = self._configuration.get('mirror_directory')
+        if self.mirror_directory is not None:
+            self.mirror_directory = os.path.normpath(os.path.join(root_directory,
+                                                                  os.path.expanduser(self.mirror_directory)))
+        if "INDEXER_MIRROR_DIRECTORY" in os.environ:
+            self.mirror_directory = os.environ["INDEXER_MIRROR_DIRECTORY"]
+            logging.warning("Using $INDEXER_MIRROR_DIRECTORY environment variable (%s)", self.mirror_directory)
+        self.refresh_interval = self._configuration.get('refresh_interval', REFRESH_INTERVAL)
+        self.sources = [self._source(definition, root_directory) for definition in self._configuration['sources']]
+
+    def _source(self, definition, root_directory):
+        # Sources are either plain Internet Archive URLs, which use the library-wide mirror if one is configured, or
+        # dictionaries with a `url` and an explicit `mirror` directory.
+        if isinstance(definition, str):
+            url, mirror_directory = definition, self.mirror_directory
+        else:
+            url = definition['url']
+            mirror_directory = definition.get('mirror', self.mirror_directory)
+            if mirror_directory is not None:
+                mirror_directory = os.path.normpath(os.path.join(root_directory, os.path.expanduser(mirror_directory)))
+        if mirror_directory is None:
+            return InternetArchiveSource(self.assets_directory, url)
+        source = LocalMirrorSource(mirror_directory, url, self.state_directory)
+        if not os.path.exists(source.path):
+            logging.warning("'%s' is missing from the mirror; falling back to the assets directory.", source.path)
+            return InternetArchiveSource(self.assets_directory, url)
+        return source
 
     def sync(self):
         logging.info("Syncing library...")
+        sync(self.sources, refresh_interval=self.refresh_interval)
+
+    def verify(self):
+        logging.info("Verifying library...")
+        failures = 0
         for source in self.sources:
-            source.sync()
+            problem = source.verify()
+            if problem is not None:
+                logging.warning("'%s' failed verification (%s).", source.path, problem)
+                failures += 1
+        logging.info("%d of %d sources verified.", len(self.sources) - failures, len(self.sources))
+        return failures == 0
+
+
+def distinct_sources(libraries):
+    """
+    Return the sources of all `libraries`, in library order, including sources shared by several libraries (i.e., with
+    the same URL) only once.
+    """
+    sources = {}
+    for library in libraries:
+        for source in library.sources:
+            sources.setdefault(source.url, source)
+    return list(sources.values())
+
+
+def sync(sources, refresh_interval=REFRESH_INTERVAL):
+    for source in sources:
+        source.sync(refresh_interval=refresh_interval)
+
+
+class BackgroundSync(object):
+    """
+    Syncs `sources` on a pool of `jobs` threads, in order, allowing each source to be indexed as soon as it has been
+    downloaded and verified rather than waiting for the whole library.
+    """
+
+    def __init__(self, sources, jobs=SYNC_JOBS, refresh_interval=REFRESH_INTERVAL):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self._futures = {source: self._executor.submit(source.sync, refresh_interval=refresh_interval)
+                         for source in sources}
+
+    def wait(self, source):
+        """
+        Block until `source` has been synced, re-raising any error encountered while syncing it.
+        """
+        future = self._futures[source]
+        if not future.done():
+            logging.info("Waiting for '%s' to sync...", source.path)
+        future.result()
+
+    def join(self):
+        try:
+            for future in self._futures.values():
+                future.result()
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def cancel(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
 
 
 def is_downloadable_package(path):
     return os.path.splitext(path)[1].lower() in DOWNLOADABLE_PACKAGES
 
 
+def file_key(path):
+    stat = os.stat(path)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def checksums(path):
+    md5 = hashlib.md5()
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as fh:
+        while True:
+            data = fh.read(1024 * 1024)
+            if not data:
+                break
+            md5.update(data)
+            sha1.update(data)
+    return md5.hexdigest(), sha1.hexdigest()
+
+
+class VerificationCache(object):
+    """
+    Records files that have previously been verified against their manifest entry, keyed by size and modification
+    time, so that unchanged files only need to be stat'd on subsequent runs.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as fh:
+                self._entries = json.load(fh)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def _key(self, stat, expected):
+        return [stat.st_size, stat.st_mtime_ns, expected['md5'], expected['sha1']]
+
+    def contains(self, name, stat, expected):
+        return self._entries.get(name) == self._key(stat, expected)
+
+    def add(self, name, stat, expected):
+        self._entries[name] = self._key(stat, expected)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as fh:
+            json.dump(self._entries, fh)
+        os.replace(temporary_path, self.path)
+
+
 
 class InternetArchiveSource(object):
 
@@ -103,46 +252,143 @@ class InternetArchiveSource(object):
         self.item_directory = os.path.join(root_directory, self.id)
         self.item_metadata_path = os.path.join(self.item_directory, f"{self.id}_meta.xml")
         self.file_metadata_path = os.path.join(self.item_directory, f"{self.id}_files.xml")
+        self.verification_cache_path = os.path.join(self.item_directory, f"{self.id}_verified.json")
+        self.validators_path = os.path.join(self.item_directory, f"{self.id}_http.json")
         self.relative_path = os.path.join(*(path_components[2:]))
         self.path = os.path.join(self.item_directory, self.relative_path)
         self._metadata = None
-
-    def sync(self):
+        self._metadata_key = None
+        self._files = None
+        self._files_key = None
+
+    def sync(self, refresh_interval=REFRESH_INTERVAL):
+        """
+        Download the item's metadata and the source asset if they're missing, revalidating previously downloaded copies
+        with conditional requests once `refresh_interval` hours have passed since they were last checked, so only
+        files that have changed upstream are downloaded again.
+        """
         logging.info("Syncing '%s'...", self.id)
+        self.sync_metadata(refresh_interval=refresh_interval)
+        validators = utils.Validators(self.validators_path)
+        interval = refresh_interval * 60 * 60
+
+        # Existing files are checked against the sizes and checksums in `_files.xml` (which will pick up any upstream
+        # changes now that it's been revalidated) and re-downloaded if they don't match, ensuring truncated or
+        # corrupted assets don't find their way into the index. Files that `_files.xml` doesn't describe are
+        # revalidated with a conditional request instead.
+        problem = self.verify()
+        if (problem is None
+                and unquote(self.relative_path) not in self.files
+                and validators.is_due(validators.name_for(self.path), interval)
+                and utils.is_modified(self.path, validators)):
+            problem = "modified upstream"
+        if problem is None:
+            return
+        if os.path.exists(self.path):
+            logging.warning("'%s' failed verification (%s); re-downloading...", self.path, problem)
+        destination_directory = os.path.dirname(self.path)
+        os.makedirs(destination_directory, exist_ok=True)
+        utils.download_file_with_mirrors([
+            self.url,
+            f"https://psion.solarcene.community/{self.id}/{self.relative_path}",
+        ], self.path, validators=validators)
+        problem = self.verify()
+        if problem is not None:
+            raise IntegrityError(f"'{self.path}' failed verification ({problem}).")
+
+    def sync_metadata(self, refresh_interval=REFRESH_INTERVAL):
+        """
+        Download the item's `_meta.xml` and `_files.xml` if they're missing, or revalidate them once `refresh_interval`
+        hours have passed since they were last checked, without syncing the source asset.
+        """
         os.makedirs(self.item_directory, exist_ok=True)
+        validators = utils.Validators(self.validators_path)
+        interval = refresh_interval * 60 * 60
 
         # This implementation fails-over to downloading from our mirror https://psion.solarcene.community if we get a
         # 503 or a timeout from the Internet Archive.
 
-        if not os.path.exists(self.item_metadata_path):
-            utils.download_file_with_mirrors([
-                f"https://archive.org/download/{self.id}/{self.id}_meta.xml",
-                f"https://psion.solarcene.community/{self.id}/{self.id}_meta.xml",
-            ], self.item_metadata_path)
-        if not os.path.exists(self.file_metadata_path):
-            utils.download_file_with_mirrors([
-                f"https://archive.org/download/{self.id}/{self.id}_files.xml",
-                f"https://psion.solarcene.community/{self.id}/{self.id}_files.xml",
-            ], self.file_metadata_path)
-        # TODO: Check the shas.
+        for path in [self.item_metadata_path, self.file_metadata_path]:
+            if os.path.exists(path) and not validators.is_due(validators.name_for(path), interval):
+                continue
+            filename = os.path.basename(path)
+            if utils.fetch_file([
+                f"https://archive.org/download/{self.id}/{filename}",
+                f"https://psion.solarcene.community/{self.id}/{filename}",
+            ], path, validators):
+                logging.info("Updated '%s'.", path)
+
+    @property
+    def size(self):
+        """
+        Size of the source asset as recorded in `_files.xml` (which must have been synced), or `None` if it isn't
+        recorded, allowing sources to be compared before they're downloaded.
+        """
+        expected = self.files.get(unquote(self.relative_path))
+        return expected['size'] if expected is not None else None
+
+    @property
+    def files(self):
+        # Metadata is reparsed only if the file has been updated since it was last read.
+        key = file_key(self.file_metadata_path)
+        if self._files is None or key != self._files_key:
+            root = ET.parse(self.file_metadata_path).getroot()
+            self._files = {}
+            for element in root.findall('./file'):
+                size = element.findtext('size')
+                self._files[element.get('name')] = {
+                    'size': int(size) if size is not None else None,
+                    'md5': element.findtext('md5'),
+                    'sha1': element.findtext('sha1'),
+                }
+            self._files_key = key
+        return self._files
+
+    def verify(self):
+        """
+        Check the local copy of the source against its entry in `_files.xml`, returning a description of the problem
+        if it doesn't match, or `None` if it does.
+        """
         if not os.path.exists(self.path):
-            destination_directory = os.path.dirname(self.path)
-            logging.info(destination_directory)
-            os.makedirs(destination_directory, exist_ok=True)
-            utils.download_file_with_mirrors([
-                self.url,
-                f"https://psion.solarcene.community/{self.id}/{self.relative_path}",
-            ], self.path)
+            return "missing"
+        if not os.path.exists(self.file_metadata_path):
+            return "missing file metadata"
+        name = unquote(self.relative_path)
+        try:
+            expected = self.files[name]
+        except KeyError:
+            logging.debug("No file metadata for '%s'; skipping verification.", name)
+            return None
+
+        stat = os.stat(self.path)
+        if expected['size'] is not None and stat.st_size != expected['size']:
+            return f"expected {expected['size']} bytes, found {stat.st_size}"
+        if expected['md5'] is None and expected['sha1'] is None:
+            return None
+
+        cache = VerificationCache(self.verification_cache_path)
+        if cache.contains(name, stat, expected):
+            return None
+        logging.info("Verifying '%s'...", self.path)
+        md5, sha1 = checksums(self.path)
+        if expected['md5'] is not None and md5 != expected['md5']:
+            return "md5 mismatch"
+        if expected['sha1'] is not None and sha1 != expected['sha1']:
+            return "sha1 mismatch"
+        cache.add(name, stat, expected)
+        return None
 
     @property
     def metadata(self):
-        if self._metadata is None:
+        key = file_key(self.item_metadata_path)
+        if self._metadata is None or key != self._metadata_key:
             with open(self.item_metadata_path) as fh:
                 root = ET.fromstring(fh.read())
                 self._metadata = {
                     'title': root.find('./title').text,
                     'description': root.find('./description').text,
                 }
+            self._metadata_key = key
         return self._metadata
 
     @property
@@ -199,3 +445,22 @@ class InternetArchiveSource(object):
             'url': self.url,
             'html_url': f"https://archive.org/details/{self.id}"
         }
+
+
+class LocalMirrorSource(InternetArchiveSource):
+    """
+    Internet Archive item in an existing local mirror (e.g., on a NAS) laid out like the assets directory. Metadata is
+    read from the mirrored `_meta.xml` and `_files.xml`, and assets are walked in place without being synced or copied;
+    references still resolve to the canonical archive.org URLs. The mirror is never written to, so the verification
+    cache is kept in the state directory instead.
+    """
+
+    def __init__(self, mirror_directory, url, state_directory):
+        super().__init__(mirror_directory, url)
+        self.verification_cache_path = os.path.join(state_directory, "verification", f"{self.id}_verified.json")
+
+    def sync(self, refresh_interval=REFRESH_INTERVAL):
+        logging.info("Using mirrored '%s' in place.", self.id)
+
+    def sync_metadata(self, refresh_interval=REFRESH_INTERVAL):
+        pass
@@ -21,8 +21,14 @@
 # SOFTWARE.
 
 import collections
+import concurrent.futures
+import io
+import itertools
 import logging
+import lzma
+import mmap
 import os
+import shutil
 import tarfile
 import tempfile
 import zipfile
@@ -31,69 +37,399 @@ import zlib
 import pycdlib
 
 import model
+import report
 
 
-def extract_iso(path, destination_path):
+ISO_SECTOR_SIZE = 2048
 
-    iso = pycdlib.PyCdlib()
-    iso.open(path)
-
-    pathname = 'iso_path'
-    if iso.has_udf():
-        pathname = 'udf_path'
-    elif iso.has_joliet():
-        pathname = 'joliet_path'
-
-    start_path = '/'
-    root_entry = iso.get_record(**{pathname: start_path})
-
-    dirs = collections.deque([root_entry])
-    while dirs:
-        dir_record = dirs.popleft()
-        ident_to_here = iso.full_path_from_dirrecord(dir_record,
-                                                     rockridge=pathname == 'rr_path')
-        relname = ident_to_here[len(start_path):]
-        if relname and relname[0] == '/':
-            relname = relname[1:]
-        if dir_record.is_dir():
-            if relname != '':
-                os.makedirs(os.path.join(destination_path, relname))
-            child_lister = iso.list_children(**{pathname: ident_to_here})
-
-            for child in child_lister:
-                if child is None or child.is_dot() or child.is_dotdot():
-                    continue
-                dirs.append(child)
-        else:
-            if dir_record.is_symlink():
-                fullpath = os.path.join(destination_path, relname)
-                local_dir = os.path.dirname(fullpath)
-                local_link_name = os.path.basename(fullpath)
-                old_dir = os.getcwd()
-                os.chdir(local_dir)
-                os.symlink(dir_record.rock_ridge.symlink_path(), local_link_name)
-                os.chdir(old_dir)
+
+class SectorLayout(object):
+    """
+    Physical layout of the sectors in a CD image: the size of each sector and the offset of the 2048 bytes of user data
+    within it. Raw images include the sync pattern, header, and error correction data around the user data.
+    """
+
+    __slots__ = ('name', 'sector_size', 'data_offset')
+
+    def __init__(self, name, sector_size, data_offset):
+        self.name = name
+        self.sector_size = sector_size
+        self.data_offset = data_offset
+
+    @property
+    def is_raw(self):
+        return self.sector_size != ISO_SECTOR_SIZE
+
+    def logical_size(self, size):
+        return (size // self.sector_size) * ISO_SECTOR_SIZE
+
+    def ranges(self, offset, length):
+        # Map a range of the logical (2048-byte sector) image onto the physical image.
+        if not self.is_raw:
+            yield (offset, length)
+            return
+        while length > 0:
+            sector, sector_offset = divmod(offset, ISO_SECTOR_SIZE)
+            count = min(length, ISO_SECTOR_SIZE - sector_offset)
+            yield (sector * self.sector_size + self.data_offset + sector_offset, count)
+            offset += count
+            length -= count
+
+
+ISO_LAYOUT = SectorLayout("ISO", ISO_SECTOR_SIZE, 0)
+
+SECTOR_LAYOUTS = [
+    ISO_LAYOUT,
+    SectorLayout("MODE1/2352", 2352, 16),
+    SectorLayout("MODE2/2352", 2352, 24),  # CD-ROM XA Form 1; 8-byte subheader follows the header.
+    SectorLayout("MODE2/2336", 2336, 8),
+]
+
+
+def detect_sector_layout(path):
+    # Look for the ISO9660 volume descriptor identifier in sector 16 using each of the layouts we know about.
+    with open(path, "rb") as fh:
+        for layout in SECTOR_LAYOUTS:
+            fh.seek(16 * layout.sector_size + layout.data_offset + 1)
+            if fh.read(5) == b"CD001":
+                return layout
+    return None
+
+
+class RawSectorReader(io.RawIOBase):
+    """
+    Read-only file object presenting the logical 2048-byte sector view of a raw CD image, stripping sector headers and
+    error correction data on the fly.
+    """
+
+    def __init__(self, data, layout):
+        self._data = data
+        self._layout = layout
+        self._size = layout.logical_size(len(data))
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self._size + offset
+        return self._position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._size - self._position)
+        if length <= 0:
+            return 0
+        written = 0
+        with memoryview(buffer) as view:
+            for offset, count in self._layout.ranges(self._position, length):
+                view[written:written + count] = self._data[offset:offset + count]
+                written += count
+        self._position += written
+        return written
+
+
+class IsoMember(object):
+
+    __slots__ = ('path', 'size', 'extents', 'record')
+
+    def __init__(self, path, size, extents, record):
+        self.path = path
+        self.size = size
+        self.extents = extents  # List of (offset, length) tuples within the image, or None if not directly readable.
+        self.record = record
+
+
+class IsoImage(object):
+    """
+    Directory tree of an ISO image, built once using pycdlib (preferring UDF, then Joliet, then ISO9660 names), with the
+    location of each member's data within the image. Members are served directly from the image using
+    `os.copy_file_range` where available, falling back to writing `mmap` slices; only members pycdlib can't locate
+    (e.g., El Torito boot catalogs) are copied through pycdlib itself.
+
+    Raw CD images (see `SECTOR_LAYOUTS`) are read through the same interface, with the sector headers and error
+    correction data skipped as members are read, avoiding the need to convert them to ISO images first.
+
+    Images are still extracted in full (see `Extractor`), as the importers and opolua work with paths, and look for
+    sibling files (e.g., AIFs next to APPs), so there's no support for reading individual members in place.
+    """
+
+    def __init__(self, path, layout=ISO_LAYOUT):
+        self.path = os.path.abspath(path)
+        self.layout = layout
+        self.directories = []
+        self.members = []
+        self.symlinks = []
+        self._iso = None
+        self._mmap = None
+        self._fh = open(self.path, "rb")
+        try:
+            self._size = layout.logical_size(os.fstat(self._fh.fileno()).st_size)
+            if self._size:
+                self._mmap = mmap.mmap(self._fh.fileno(), 0, access=mmap.ACCESS_READ)
+            self._iso = pycdlib.PyCdlib()
+            if layout.is_raw:
+                self._iso.open_fp(io.BufferedReader(RawSectorReader(self._mmap, layout), 64 * 1024))
             else:
-                iso.get_file_from_iso(os.path.join(destination_path, relname), **{pathname: ident_to_here})
+                self._iso.open_fp(self._fh)
+            self._load()
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._iso is not None:
+            self._iso.close()
+            self._iso = None
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def _load(self):
+        iso = self._iso
+        self._pathname = 'iso_path'
+        if iso.has_udf():
+            self._pathname = 'udf_path'
+        elif iso.has_joliet():
+            self._pathname = 'joliet_path'
+
+        boot_records = set()
+        if iso.eltorito_boot_catalog is not None:
+            boot_records = set(id(record) for record in iso.eltorito_boot_catalog.dirrecords)
+
+        start_path = '/'
+        root_entry = iso.get_record(**{self._pathname: start_path})
+
+        dirs = collections.deque([root_entry])
+        while dirs:
+            dir_record = dirs.popleft()
+            ident_to_here = iso.full_path_from_dirrecord(dir_record,
+                                                         rockridge=self._pathname == 'rr_path')
+            relname = ident_to_here[len(start_path):]
+            if relname and relname[0] == '/':
+                relname = relname[1:]
+            if dir_record.is_dir():
+                if relname != '':
+                    self.directories.append(relname)
+                child_lister = iso.list_children(**{self._pathname: ident_to_here})
+
+                for child in child_lister:
+                    if child is None or child.is_dot() or child.is_dotdot():
+                        continue
+                    dirs.append(child)
+            elif dir_record.is_symlink():
+                self.symlinks.append((relname, dir_record.rock_ridge.symlink_path()))
+            else:
+                extents = None if id(dir_record) in boot_records else self._extents(dir_record, relname)
+                size = sum(length for _, length in extents) if extents is not None else dir_record.get_data_length()
+                self.members.append(IsoMember(relname, size, extents, ident_to_here))
+
+    def _extents(self, record, relname):
+        block_size = self._iso.logical_block_size
+        extents = []
+        while record is not None:
+            length = record.get_data_length()
+            if length > 0:
+                ino = record.inode
+                if (ino is None
+                        or ino.orig_extent_loc is None
+                        or ino.original_data_location != ino.DATA_ON_ORIGINAL_ISO
+                        or ino.boot_info_table is not None):
+                    return None
+                offset = (ino.orig_extent_loc + (getattr(record, 'data_extent_offset', 0) or 0)) * block_size
+                if offset + length > self._size:
+                    logging.warning("Member '%s' extends beyond the end of '%s'.", relname, self.path)
+                    length = max(0, self._size - offset)
+                extents.append((offset, length))
+            record = getattr(record, 'data_continuation', None)
+        return extents
+
+    def extract(self, member, destination_path):
+        if member.extents is None:
+            self._iso.get_file_from_iso(destination_path, **{self._pathname: member.record})
+            return
+        with open(destination_path, "wb") as fh:
+            for offset, length in member.extents:
+                if self.layout.is_raw:
+                    write_ranges(self._mmap, fh.fileno(), self.layout.ranges(offset, length))
+                else:
+                    copy_range(self._fh.fileno(), self._mmap, fh.fileno(), offset, length)
+
+    def extractall(self, destination_path):
+        for directory in self.directories:
+            os.makedirs(os.path.join(destination_path, directory))
+        for member in self.members:
+            self.extract(member, os.path.join(destination_path, member.path))
+        for relname, target in self.symlinks:
+            os.symlink(target, os.path.join(destination_path, relname))
+
+
+def copy_range(source_fd, source_mmap, destination_fd, offset, length):
+    # Let the kernel copy the data where it can, falling back to writing directly from the memory-mapped image.
+    if hasattr(os, "copy_file_range"):
+        try:
+            while length > 0:
+                copied = os.copy_file_range(source_fd, destination_fd, length, offset_src=offset)
+                if copied == 0:
+                    break
+                offset += copied
+                length -= copied
+        except OSError:
+            pass
+    if length > 0:
+        with memoryview(source_mmap) as view:
+            data = view[offset:offset + length]
+            while len(data):
+                written = os.write(destination_fd, data)
+                data = data[written:]
+
+
+def write_ranges(source_mmap, destination_fd, ranges, batch_size=512):
+    # Gather the sector payloads of a raw image into vectored writes directly from the memory-mapped image.
+    with memoryview(source_mmap) as view:
+        ranges = iter(ranges)
+        while True:
+            buffers = [view[offset:offset + count] for offset, count in itertools.islice(ranges, batch_size)]
+            if not buffers:
+                break
+            written = os.writev(destination_fd, buffers)
+            for buffer in buffers:
+                if written >= len(buffer):
+                    written -= len(buffer)
+                    continue
+                remaining = buffer[written:]
+                while len(remaining):
+                    remaining = remaining[os.write(destination_fd, remaining):]
+                written = 0
+
+
+def extract_iso(path, destination_path):
+    with IsoImage(path) as iso:
+        iso.extractall(destination_path)
+
+
+def is_cd_image(path):
+    # `.bin` files may be raw images or plain ISO images (2048-byte sectors); both are read through `IsoImage`.
+    try:
+        layout = detect_sector_layout(path)
+    except OSError:
+        return False
+    return layout is not None
+
+
+def extract_cd_image(path, destination_path):
+    layout = detect_sector_layout(path)
+    if layout is None:
+        raise NotImplementedError(f"Unsupported CD image '{path}'.")
+    logging.debug("Reading '%s' as %s image...", path, layout.name)
+    with IsoImage(path, layout=layout) as iso:
+        iso.extractall(destination_path)
 
 
 def extract_tar(source, destination):
-    with tarfile.TarFile(source) as tar:
+    # Reading the archive as a stream means we get transparent gzip, bzip2, and xz decompression, and members are
+    # extracted in a single sequential pass as they're read.
+    with tarfile.open(source, mode="r|*") as tar:
         tar.extractall(path=destination)
 
 
+def zip_member_path(destination, member):
+    # Matches the sanitisation performed by `ZipFile.extract`, discarding drive letters, empty, current and parent
+    # directory components.
+    arcname = member.filename.replace('/', os.path.sep)
+    if os.path.altsep:
+        arcname = arcname.replace(os.path.altsep, os.path.sep)
+    arcname = os.path.splitdrive(arcname)[1]
+    invalid_path_parts = ('', os.path.curdir, os.path.pardir)
+    arcname = os.path.sep.join(x for x in arcname.split(os.path.sep) if x not in invalid_path_parts)
+    return os.path.join(destination, arcname)
+
+
 def extract_zip(source, destination):
     with zipfile.ZipFile(source) as zip:
-        zip.extractall(path=destination)
+
+        # Create the directory structure up-front so the members can be written concurrently.
+        members = []
+        for member in zip.infolist():
+            path = zip_member_path(destination, member)
+            if path == destination:
+                continue
+            if member.is_dir():
+                os.makedirs(path, exist_ok=True)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            members.append((member, path))
+
+        # Members that would be written to the same file, including on case-insensitive file systems, are grouped so
+        # they're extracted sequentially in archive order, leaving the last one as a sequential extraction would.
+        groups = {}
+        for member, path in members:
+            groups.setdefault(os.path.normcase(path).lower(), []).append((member, path))
+
+        # zlib releases the GIL while decompressing, so groups can be decompressed in parallel; the largest groups are
+        # scheduled first to keep the workers evenly loaded.
+        def extract_members(group):
+            for member, path in group:
+                with zip.open(member) as source_fh, open(path, "wb") as destination_fh:
+                    shutil.copyfileobj(source_fh, destination_fh, 1024 * 1024)
+
+        jobs = sorted(groups.values(), key=lambda group: sum(member.file_size for member, _ in group), reverse=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            futures = [executor.submit(extract_members, group) for group in jobs]
+            for future in futures:
+                future.result()
 
 
 CONTAINER_MAPPING = {
+    ".bin": extract_cd_image,
     ".iso": extract_iso,
     ".tar": extract_tar,
+    ".tar.bz2": extract_tar,
+    ".tar.gz": extract_tar,
+    ".tar.xz": extract_tar,
+    ".tbz2": extract_tar,
+    ".tgz": extract_tar,
+    ".txz": extract_tar,
     ".zip": extract_zip,
 }
 
 
+# Extensions that are also used for files other than containers; these are only treated as containers if their contents
+# match.
+CONTAINER_PROBES = {
+    ".bin": is_cd_image,
+}
+
+
+def container_extension(path):
+    basename = os.path.basename(path).lower()
+    for ext in CONTAINER_MAPPING:
+        if basename.endswith(ext) and len(basename) > len(ext):
+            if ext in CONTAINER_PROBES and not CONTAINER_PROBES[ext](path):
+                return None
+            return ext
+    return None
+
+
 class Extractor(object):
 
     def __init__(self, path, method):
@@ -106,6 +442,9 @@ class Extractor(object):
         os.chdir(self.temporary_directory.name)
         try:
             self.method(self.path, self.temporary_directory.name)
+            report.RUN.extracted(sum([os.path.getsize(os.path.join(root, name))
+                                      for root, _, files in os.walk(self.temporary_directory.name)
+                                      for name in files]))
             return self.temporary_directory.name
         except:
             os.chdir(self.pwd)
@@ -122,16 +461,17 @@ def walk(path, reference=None, relative_to=None):
     path = os.path.abspath(path)
     if os.path.isdir(path):
         for root, dirs, files in os.walk(path):
-            for a in [os.path.join(root, f) for f in files]:
+            # Walk in a stable order so every machine sees the same sequence of assets (see `indexer.Shard`).
+            dirs.sort()
+            for a in [os.path.join(root, f) for f in sorted(files)]:
                 reference_item = model.ReferenceItem(name=os.path.relpath(a, relative_to), url=None)
                 for (inner_path, inner_reference) in walk(a, reference=reference, relative_to=relative_to):
                     yield (inner_path, inner_reference)
     else:
         reference_item = model.ReferenceItem(name=os.path.relpath(path, relative_to), url=None)
-        _, ext = os.path.splitext(path)
-        ext = ext.lower()
+        ext = container_extension(path)
 
-        if ext in CONTAINER_MAPPING:
+        if ext is not None:
             logging.debug("Extracting '%s'...", path)
             try:
                 with Extractor(path, method=CONTAINER_MAPPING[ext]) as contents_path:
@@ -139,7 +479,14 @@ def walk(path, reference=None, relative_to=None):
                                                               reference=reference + [reference_item],
                                                               relative_to=contents_path):
                         yield (inner_path, inner_reference)
-            except (NotImplementedError, zipfile.BadZipFile, OSError, RuntimeError, tarfile.ReadError, zlib.error) as e:
+            except (NotImplementedError,
+                    zipfile.BadZipFile,
+                    OSError,
+                    RuntimeError,
+                    EOFError,
+                    tarfile.TarError,
+                    lzma.LZMAError,
+                    zlib.error) as e:
                 logging.warning("Failed to extract file '%s' with error '%s'.", path, e)
         else:
             yield (path, reference + [reference_item])
@@ -0,0 +1,373 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import binascii
+import re
+import struct
+
+from PIL import Image as PILImage
+
+
+# Pure-Python readers for the EPOC file formats we need during indexing; these avoid launching a Lua process (and
+# round-tripping through temporary files) for the common cases, leaving opolua to handle everything else.
+
+KUidDirectFileStore = 0x10000037
+KUidAppInfoFile = 0x1000006A
+KUidMultiBitmapFileImage = 0x10000042
+
+BITMAP_HEADER = struct.Struct("<IIIIIIIIII")
+BITMAP_HEADER_LENGTH = BITMAP_HEADER.size
+MAXIMUM_BITMAP_SIDE = 4096
+
+COMPRESSION_NONE = 0
+COMPRESSION_BYTE_RLE = 1
+
+# TRgb::Color16 (EPOC's 16 colour palette), as (r, g, b).
+COLOR16_PALETTE = [
+    (0x00, 0x00, 0x00),
+    (0x55, 0x55, 0x55),
+    (0x80, 0x00, 0x00),
+    (0x80, 0x80, 0x00),
+    (0x00, 0x80, 0x00),
+    (0xff, 0x00, 0x00),
+    (0xff, 0xff, 0x00),
+    (0x00, 0xff, 0x00),
+    (0xff, 0x00, 0xff),
+    (0x00, 0x00, 0xff),
+    (0x00, 0xff, 0xff),
+    (0x80, 0x00, 0x80),
+    (0x00, 0x00, 0x80),
+    (0x00, 0x80, 0x80),
+    (0xaa, 0xaa, 0xaa),
+    (0xff, 0xff, 0xff),
+]
+
+
+class UnsupportedFormat(Exception):
+    pass
+
+
+def pixel_order_table(bpp):
+    # EPOC packs pixels least significant bits first, whereas PIL's unpackers expect the first pixel in the most
+    # significant bits; this table reverses the order of the pixels within each byte (but not the bits of each pixel).
+    pixels_per_byte = 8 // bpp
+    mask = (1 << bpp) - 1
+    table = bytearray(256)
+    for byte in range(256):
+        value = 0
+        for index in range(pixels_per_byte):
+            pixel = (byte >> (index * bpp)) & mask
+            value |= pixel << ((pixels_per_byte - 1 - index) * bpp)
+        table[byte] = value
+    return bytes(table)
+
+
+PIXEL_ORDER_TABLES = {bpp: pixel_order_table(bpp) for bpp in (1, 2, 4)}
+
+
+def grey_palette(bpp):
+    levels = 1 << bpp
+    return [(value * 255 // (levels - 1),) * 3 for value in range(levels)]
+
+
+class Bitmap(object):
+
+    __slots__ = ('width', 'height', 'bpp', 'colour', 'compression', 'length', '_data')
+
+    def __init__(self, width, height, bpp, colour, compression, length, data):
+        self.width = width
+        self.height = height
+        self.bpp = bpp
+        self.colour = colour
+        self.compression = compression
+        self.length = length  # Total length of the bitmap, including the header.
+        self._data = data
+
+    @property
+    def stride(self):
+        # Scan lines are padded to a 32-bit boundary.
+        return ((self.width * self.bpp + 31) // 32) * 4
+
+    @property
+    def palette(self):
+        if not self.colour:
+            return grey_palette(self.bpp)
+        if self.bpp == 4:
+            return COLOR16_PALETTE
+        raise UnsupportedFormat(f"Unsupported {self.bpp}bpp colour bitmap")
+
+    def pixels(self):
+        size = self.stride * self.height
+        if self.compression == COMPRESSION_NONE:
+            data = bytes(self._data[:size])
+        elif self.compression == COMPRESSION_BYTE_RLE:
+            data = decode_byte_rle(self._data, size)
+        else:
+            raise UnsupportedFormat(f"Unsupported bitmap compression {self.compression}")
+        if len(data) < size:
+            raise UnsupportedFormat("Truncated bitmap data")
+        return data
+
+    def image(self):
+        """
+        Decode the bitmap into a paletted PIL image; unpacking is performed by PIL's raw decoder.
+        """
+        palette = self.palette
+        data = self.pixels()
+        if self.bpp < 8:
+            data = data.translate(PIXEL_ORDER_TABLES[self.bpp])
+            rawmode = f"P;{self.bpp}"
+        else:
+            rawmode = "P"
+        image = PILImage.frombytes("P", (self.width, self.height), data, "raw", rawmode, self.stride, 1)
+        image.putpalette([component for colour in palette for component in colour])
+        return image
+
+
+def read_cardinality(data, offset):
+    # TCardinality; the low bits of the first byte indicate whether the value is stored in 1, 2, or 4 bytes.
+    byte = data[offset]
+    if byte & 0x01 == 0:
+        return byte >> 1, offset + 1
+    if byte & 0x02 == 0:
+        return struct.unpack_from("<H", data, offset)[0] >> 2, offset + 2
+    return struct.unpack_from("<I", data, offset)[0] >> 3, offset + 4
+
+
+def read_uids(data):
+    if len(data) < 20:
+        raise UnsupportedFormat("File too short")
+    return struct.unpack_from("<IIII", data, 0)
+
+
+def read_bitmap(data, offset):
+    # SEpocBitmapHeader, immediately followed by the bitmap data.
+    if offset < 0 or offset + BITMAP_HEADER_LENGTH > len(data):
+        raise UnsupportedFormat(f"Invalid bitmap offset {offset}")
+    (length, header_length, width, height, _, _, bpp, colour, palette_size, compression) = \
+        BITMAP_HEADER.unpack_from(data, offset)
+    if (header_length != BITMAP_HEADER_LENGTH
+            or length < header_length
+            or offset + length > len(data)
+            or not 0 < width <= MAXIMUM_BITMAP_SIDE
+            or not 0 < height <= MAXIMUM_BITMAP_SIDE
+            or bpp not in (1, 2, 4, 8)
+            or colour not in (0, 1)
+            or palette_size != 0):
+        raise UnsupportedFormat(f"Invalid or unsupported bitmap header at offset {offset}")
+    with memoryview(data) as view:
+        bitmap_data = bytes(view[offset + header_length:offset + length])
+    return Bitmap(width, height, bpp, colour, compression, length, bitmap_data)
+
+
+def decode_byte_rle(data, size):
+    # Each run starts with a signed count; non-negative counts repeat the following byte count + 1 times, and negative
+    # counts are followed by -count literal bytes.
+    output = bytearray()
+    position = 0
+    while position < len(data) and len(output) < size:
+        count = data[position]
+        position += 1
+        if count < 0x80:
+            output += data[position:position + 1] * (count + 1)
+            position += 1
+        else:
+            count = 0x100 - count
+            output += data[position:position + count]
+            position += count
+    return bytes(output[:size])
+
+
+def read_mbm(data):
+    """
+    Return the bitmaps in an EPOC multi-bitmap (MBM) file.
+    """
+    uid1, uid2, _, _ = read_uids(data)
+    if uid1 != KUidDirectFileStore or uid2 != KUidMultiBitmapFileImage:
+        raise UnsupportedFormat("Not an MBM file")
+    trailer_offset = struct.unpack_from("<I", data, 16)[0]
+    count = struct.unpack_from("<I", data, trailer_offset)[0]
+    offsets = struct.unpack_from(f"<{count}I", data, trailer_offset + 4)
+    return [read_bitmap(data, offset) for offset in offsets]
+
+
+def read_icon_array(data, offset):
+    # CArrayFix<TApaAIFIconHeader>; each icon is stored as a stream identifier (its offset in a direct file store) and
+    # the side of the icon in pixels.
+    count, offset = read_cardinality(data, offset)
+    icons = []
+    for _ in range(count):
+        stream_offset, _ = struct.unpack_from("<IH", data, offset)
+        offset += 6
+        bitmap = read_bitmap(data, stream_offset)
+        mask = read_bitmap(data, stream_offset + bitmap.length)
+        icons.append((bitmap, mask))
+    return icons
+
+
+def read_aif_icons(data):
+    """
+    Return the icons in an ER5 AIF file as a list of (bitmap, mask) tuples.
+    """
+    uid1, uid2, _, _ = read_uids(data)
+    if uid1 != KUidDirectFileStore or uid2 != KUidAppInfoFile:
+        raise UnsupportedFormat("Not an AIF file")
+    root_offset = struct.unpack_from("<I", data, 16)[0]
+
+    # The root stream holds the captions, followed by the icons. Depending on the writer, the arrays are either stored
+    # inline, or as separate streams referenced by offset, so we try both, relying on the bitmap header validation to
+    # reject the wrong interpretation.
+    def inline_icon_array_offset():
+        count, offset = read_cardinality(data, root_offset)
+        return offset + count * 6
+
+    def referenced_icon_array_offset():
+        return struct.unpack_from("<I", data, root_offset + 4)[0]
+
+    for icon_array_offset in (inline_icon_array_offset, referenced_icon_array_offset):
+        try:
+            icons = read_icon_array(data, icon_array_offset())
+        except (UnsupportedFormat, struct.error, IndexError):
+            continue
+        if icons:
+            return icons
+    raise UnsupportedFormat("Unable to locate AIF icons")
+
+
+# Pre-classification; cheaply rules out files that can't possibly be recognised by `recognize.lua` (images, text,
+# HTML, documents, etc.) from the first few bytes, avoiding a Lua process launch for each.
+
+CLASSIFIER_HEADER_LENGTH = 32
+
+KUidPermanentFileStore = 0x10000050
+KUidDynamicLibrary = 0x10000079
+KUidExecutableImage = 0x1000007A
+KUidMultiBitmapRomImage = 0x10000041
+KUidInstallApp = 0x1000006D
+KUidSisFileEr5 = 0x10000419
+
+EPOC32_UID1S = set([
+    KUidDirectFileStore,
+    KUidPermanentFileStore,
+    KUidDynamicLibrary,
+    KUidExecutableImage,
+    KUidMultiBitmapRomImage,
+])
+
+# SIBO files start with an ASCII signature, usually terminated by '**' (e.g., 'OPLObjectFile**', 'ImageFileType**').
+SIBO_SIGNATURE = re.compile(rb"^[A-Za-z]{4,16}\*\*")
+SIBO_PREFIXES = [
+    b"OPLDatabaseFile",
+    b"PIC\xdc",
+]
+
+
+def uid_checksum(uids):
+    # TCheckedUid::Check; CRC-CCITT of the odd and even bytes of the three UIDs.
+    return (binascii.crc_hqx(uids[1:12:2], 0) << 16) | binascii.crc_hqx(uids[0:12:2], 0)
+
+
+def classify(header):
+    """
+    Return 'epoc32' or 'sibo' if `header` (the first `CLASSIFIER_HEADER_LENGTH` bytes of a file) looks like it might be
+    a Psion file, or None if it definitely isn't one.
+    """
+    if len(header) >= 16:
+        uid1, uid2, uid3, checksum = struct.unpack_from("<IIII", header, 0)
+        if uid1 in EPOC32_UID1S or uid2 == KUidInstallApp or uid3 == KUidSisFileEr5:
+            return "epoc32"
+        if (uid1 or uid2 or uid3) and uid_checksum(header[:12]) == checksum:
+            return "epoc32"
+    if SIBO_SIGNATURE.match(header) or any(header.startswith(prefix) for prefix in SIBO_PREFIXES):
+        return "sibo"
+    return None
+
+
+def is_candidate(path):
+    with open(path, "rb") as fh:
+        return classify(fh.read(CLASSIFIER_HEADER_LENGTH)) is not None
+
+
+# ER5 SIS files; only the file table is read here (metadata still comes from `dumpsis.lua`), allowing the contents of
+# an installer to be inspected in memory without extracting it.
+
+SIS_HEADER = struct.Struct("<IIIIHHHHHHHHIHHHHIIIIII")
+SIS_OPTION_UNICODE = 0x0001
+
+SIS_RECORD_SIMPLE_FILE = 0
+SIS_RECORD_MULTI_LANGUAGE_FILE = 1
+
+SIS_FILE_NULL = 4
+
+
+class SisFile(object):
+
+    __slots__ = ('destination', 'type', 'data')
+
+    def __init__(self, destination, type, data):
+        self.destination = destination
+        self.type = type
+        self.data = data
+
+    @property
+    def path(self):
+        # Destinations are absolute EPOC paths (e.g., '!:\System\Apps\Foo\Foo.app'); drop the drive.
+        components = [component for component in self.destination.split("\\") if component]
+        if components and components[0].endswith(":"):
+            components = components[1:]
+        return "/".join(components)
+
+
+def read_sis_files(data):
+    """
+    Return the files embedded in the ER5 SIS file `data` as `SisFile`s whose `data` are views onto `data`, using the
+    first language variant of multi-language files. Raises `UnsupportedFormat` for anything other than simple ER5
+    installers (e.g., those with option records).
+    """
+    if len(data) < SIS_HEADER.size:
+        raise UnsupportedFormat("File too short")
+    (_, uid2, uid3, _, _, language_count, file_count, _, _, _, _, _, _, options, _, _, _, _, _, files_pointer, _, _,
+     _) = SIS_HEADER.unpack_from(data, 0)
+    if uid2 != KUidInstallApp or uid3 != KUidSisFileEr5:
+        raise UnsupportedFormat("Not an ER5 SIS file")
+    encoding = "utf-16-le" if options & SIS_OPTION_UNICODE else "cp1252"
+
+    view = memoryview(data)
+    files = []
+    offset = files_pointer
+    for _ in range(file_count):
+        record_type, = struct.unpack_from("<I", data, offset)
+        if record_type == SIS_RECORD_SIMPLE_FILE:
+            variants = 1
+        elif record_type == SIS_RECORD_MULTI_LANGUAGE_FILE:
+            variants = language_count
+        else:
+            raise UnsupportedFormat(f"Unsupported file record type {record_type}")
+        (file_type, _, _, _, destination_length, destination_pointer) = struct.unpack_from("<6I", data, offset + 4)
+        lengths = struct.unpack_from(f"<{variants}I", data, offset + 28)
+        pointers = struct.unpack_from(f"<{variants}I", data, offset + 28 + 4 * variants)
+        offset += 28 + 8 * variants
+        if destination_pointer + destination_length > len(data) or pointers[0] + lengths[0] > len(data):
+            raise UnsupportedFormat("Truncated file record")
+        if file_type == SIS_FILE_NULL:
+            continue
+        destination = bytes(view[destination_pointer:destination_pointer + destination_length]).decode(encoding)
+        files.append(SisFile(destination, file_type, view[pointers[0]:pointers[0] + lengths[0]]))
+    return files
@@ -26,10 +26,12 @@ import base64
 import collections
 import contextlib
 import csv
+import fnmatch
 import glob
 import hashlib
 import json
 import logging
+import math
 import os
 import re
 import shutil
@@ -41,14 +43,23 @@ from enum import Enum
 
 import frontmatter
 import natsort
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
 
 from PIL import Image as PILImage, ImageOps
 
+import changes
+import checkpoint
 import common
-import containers
+import epoc
 import model
 import opolua
-import utils
+import packed
+import quarantine
+import render
+import report
+import stream
 
 TOOLS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIRECTORY = os.path.dirname(TOOLS_DIRECTORY)
@@ -57,27 +68,6 @@ verbose = '--verbose' in sys.argv[1:] or '-v' in sys.argv[1:]
 logging.basicConfig(level=logging.DEBUG if verbose else logging.INFO, format="[%(levelname)s] %(message)s")
 
 
-# These SIS files currently cause issues with the extraction tools we're using so they're being ignored for the time
-# being to allow us to make progress with some of the existing libraries.
-IGNORED = set([
-    "netutils.sis",
-    "NETUTILS.SIS",
-    "NetUtils.sis",
-    "nEzumi 2.sis",
-    "RevoSDK.zip",
-    "SCOMMSW.SIS",
-
-    # pilowar
-    "cclock.sis",
-    "japoleon.sis",
-    "GeneWar.sis",
-    "Re-mem.app",
-    "RateCalc.sis",
-    "CubeLine.sis",
-    "WinEPOC.sis",
-    "PsiStatsPro.sis",
-])
-
 LIBRARY_INDEXES = [
     "library/epocgames",
     "library/epocgraphics",
@@ -106,8 +96,18 @@ LIBRARY_INDEXES = [
     "library/siena",
 ]
 
+# Icons are packed into sprite atlases of up to ATLAS_COLUMNS x ATLAS_COLUMNS icons of the same size.
+ATLAS_COLUMNS = 32
+ATLASES_DIRECTORY = "atlases"
+
+# Readmes are stored as content-addressed text blobs, with only an excerpt included in the program index.
+READMES_DIRECTORY = "readmes"
+README_EXCERPT_LENGTH = 200
+
 LANGUAGE_ORDER = ["en_GB", "en_US", "en_AU", "fr_FR", "de_DE", "it_IT", "nl_NL", "bg_BG", ""]
 
+COMMANDS = ["sync", "verify", "index", "merge", "overlay", "render", "quarantine", "report", "check-classifier"]
+
 
 class ReleaseKind(Enum):
     INSTALLER = "installer"
@@ -175,8 +175,107 @@ class Summary(object):
         }
 
 
+class Shard(object):
+    """
+    Deterministic, size-balanced, assignment of a library's sources to shard `index` of `count` (1-based). Sources are
+    assigned whole, before they're downloaded or extracted, so each shard only syncs, extracts, and walks its own. Every
+    shard considers the same sources in library order and assigns each to the least-loaded shard so far, using the size
+    recorded in the source's `_files.xml`, so shards agree on the assignment without any coordination.
+    """
+
+    __slots__ = ('index', 'count')
+
+    def __init__(self, index, count):
+        self.index = index
+        self.count = count
+
+    @property
+    def name(self):
+        return f"{self.index}-{self.count}"
+
+    def select(self, sources):
+        """
+        Return those of `sources` assigned to this shard. The file metadata of every source needs to have been
+        synced (see `InternetArchiveSource.sync_metadata`).
+        """
+        loads = [0] * self.count
+        paths = set()
+        selected = []
+        for source in sources:
+            if source.path in paths:
+                continue
+            paths.add(source.path)
+            if not os.path.exists(source.file_metadata_path):
+                exit(f"Missing file metadata for '{source.id}'; run 'sync' to assign sources to shards.")
+            shard = min(range(self.count), key=lambda i: loads[i])
+            loads[shard] += source.size or 0
+            if shard == self.index - 1:
+                selected.append(source)
+        return selected
+
+
+def parse_shard(value):
+    match = re.match(r"^(\d+)/(\d+)$", value)
+    if not match:
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}' (expected i/n)")
+    index, count = int(match.group(1)), int(match.group(2))
+    if count < 1 or index < 1 or index > count:
+        raise argparse.ArgumentTypeError(f"invalid shard '{value}' (expected 1 <= i <= n)")
+    return Shard(index, count)
+
+
+class Selection(object):
+    """
+    Filters restricting `index` and `overlay` to particular sources (by Internet Archive identifier), program UIDs, or
+    asset paths (globs matched against the path of the asset within its source, e.g., `3LIBJUNE05.iso/APPS/*.SIS`).
+    Assets and programs must match every filter given.
+    """
+
+    __slots__ = ('sources', 'uids', 'path_globs')
+
+    def __init__(self, sources=None, uids=None, path_globs=None):
+        self.sources = set(sources or [])
+        self.uids = set([uid.lower() for uid in uids or []])
+        self.path_globs = list(path_globs or [])
+
+    def includes_source(self, source):
+        return not self.sources or source.id in self.sources
+
+    def _includes_path(self, path):
+        return not self.path_globs or any(fnmatch.fnmatchcase(path, path_glob) for path_glob in self.path_globs)
+
+    def includes_asset(self, asset, records):
+        """
+        Return whether the asset `asset`, last imported as the release `records` (if any), is selected. Assets are
+        selected by UID using the releases previously recorded for them.
+        """
+        if self.uids and not any(record['uid'].lower() in self.uids for record in records):
+            return False
+        return self._includes_path(asset)
+
+    def includes_program(self, program, source_urls):
+        """
+        Return whether the program dictionary `program` is selected, given the URLs of the selected sources.
+        """
+        if self.uids and program['uid'].lower() not in self.uids:
+            return False
+        if not self.sources and not self.path_globs:
+            return True
+        for version in program['versions']:
+            for variant in version['variants']:
+                for release in variant['items']:
+                    reference = release['reference']
+                    if self.sources and reference[0]['url'] not in source_urls:
+                        continue
+                    if self._includes_path("/".join(item['name'] for item in reference)):
+                        return True
+        return False
+
+
 class Version(object):
 
+    __slots__ = ('installers', 'variants')
+
     def __init__(self, installers):
         self.installers = installers
         self.variants = group_collections(installers, lambda x: x.sha256)
@@ -185,15 +284,18 @@ class Version(object):
     def version(self):
         return self.installers[0].version
 
-    def as_dict(self, relative_icons_path):
+    def as_dict(self, relative_icons_path, atlases):
         return {
             'version': self.version,
-            'variants': [variant.as_dict(relative_icons_path=relative_icons_path) for variant in self.variants],
+            'variants': [variant.as_dict(relative_icons_path=relative_icons_path, atlases=atlases)
+                         for variant in self.variants],
         }
 
 
 class Program(object):
 
+    __slots__ = ('uid', 'installers', 'screenshots', 'versions', 'tags', 'kinds')
+
     def __init__(self, uid, installers, screenshots):
         self.uid = uid
         self.installers = installers  # TODO: Item / Program / Release?
@@ -233,12 +335,13 @@ class Program(object):
         return select_icon([installer.icon for installer in self.installers
                             if installer.icon])
 
-    def as_dict(self, relative_icons_path):
+    def as_dict(self, relative_icons_path, atlases):
         dict = {
             'uid': self.uid,
             'name': self.name,
             'summary': self.summary,
-            'versions': [version.as_dict(relative_icons_path=relative_icons_path) for version in self.versions],
+            'versions': [version.as_dict(relative_icons_path=relative_icons_path, atlases=atlases)
+                         for version in self.versions],
             'tags': sorted(list(self.tags)),
             'kinds': sorted([kind.value for kind in self.kinds]),
         }
@@ -247,19 +350,17 @@ class Program(object):
             dict['summary'] = summary
         readme = self.readme
         if readme:
-            dict['readme'] = readme
+            dict['readme'] = readme_dict(readme, relative_readmes_path=READMES_DIRECTORY)
         icon = self.icon
         if icon:
-            dict['icon'] = {
-                'path': os.path.join(relative_icons_path, icon.filename),
-                'width': icon.width,
-                'height': icon.height,
-            }
+            dict['icon'] = icon_dict(icon, relative_icons_path=relative_icons_path, atlases=atlases)
         return dict
 
 
 class Release(object):
 
+    __slots__ = ('reference', 'kind', 'uid', 'sha256', 'name', 'version', 'icons', 'summary', 'readme', 'icon', 'tags')
+
     # TODO: Rename UID to identifier everywhere.
     def __init__(self, reference, kind, identifier, sha256, name, version, icons, summary, readme, tags):
         self.reference = reference
@@ -274,7 +375,7 @@ class Release(object):
         self.icon = select_icon(self.icons)
         self.tags = tags
 
-    def as_dict(self, relative_icons_path):
+    def as_dict(self, relative_icons_path, atlases):
         dict = {
             'reference': [item.as_dict() for item in self.reference],
             'kind': self.kind.value,
@@ -285,17 +386,35 @@ class Release(object):
             'tags': sorted(list(self.tags)),
         }
         if self.icon is not None:
-            dict['icon'] = {
-                'path': os.path.join(relative_icons_path, self.icon.filename),
-                'width': self.icon.width,
-                'height': self.icon.height,
-            }
+            dict['icon'] = icon_dict(self.icon, relative_icons_path=relative_icons_path, atlases=atlases)
         return dict
 
-    def write_assets(self, icons_path):
-        if self.icon is None:
-            return
-        self.icon.write(directory_path=icons_path)
+    def as_record(self):
+        return {
+            'reference': [item.as_dict() for item in self.reference],
+            'kind': self.kind.value,
+            'uid': self.uid,
+            'sha256': self.sha256,
+            'name': self.name,
+            'version': self.version,
+            'icons': [[icon.shasum, icon.width, icon.height, icon.bpp] for icon in self.icons],
+            'summary': self.summary,
+            'readme': [self.readme.sha256, self.readme.size, self.readme.excerpt] if self.readme else None,
+            'tags': sorted(list(self.tags)),
+        }
+
+    @classmethod
+    def from_record(cls, record):
+        return cls(reference=[model.ReferenceItem(**item) for item in record['reference']],
+                   kind=ReleaseKind(record['kind']),
+                   identifier=record['uid'],
+                   sha256=record['sha256'],
+                   name=record['name'],
+                   version=record['version'],
+                   icons=[model.Icon(*icon) for icon in record['icons']],
+                   summary=record['summary'],
+                   readme=model.Readme(*record['readme']) if record['readme'] else None,
+                   tags=set(record['tags']))
 
 
 class Reference(object):
@@ -325,11 +444,34 @@ def find_sibling(path, name):
             return os.path.join(directory_path, f)
 
 
-def readme_for(path):
+def readme_for(path, readmes_path):
+    """
+    Store the readme alongside `path`, if any, as a content-addressed text blob in `readmes_path` (many programs share
+    the same readme), returning a `model.Readme` descriptor with a short excerpt.
+    """
     readme_path = find_sibling(path, "readme.txt")
-    if readme_path:
-        with open(readme_path, "rb") as fh:
-            return decode(fh.read())
+    if not readme_path:
+        return None
+    with open(readme_path, "rb") as fh:
+        text = decode(fh.read())
+    data = text.encode("utf-8")
+    readme = model.Readme(sha256=hashlib.sha256(data).hexdigest(),
+                          size=len(data),
+                          excerpt=" ".join(text[:README_EXCERPT_LENGTH * 2].split())[:README_EXCERPT_LENGTH])
+    blob_path = os.path.join(readmes_path, readme.filename)
+    if not os.path.exists(blob_path):
+        with open(blob_path, "wb") as fh:
+            fh.write(data)
+    return readme
+
+
+def readme_dict(readme, relative_readmes_path):
+    return {
+        'path': os.path.join(relative_readmes_path, readme.filename),
+        'sha256': readme.sha256,
+        'size': readme.size,
+        'excerpt': readme.excerpt,
+    }
 
 
 def select_icon(icons):
@@ -340,6 +482,82 @@ def select_icon(icons):
     return icons[0]
 
 
+def store_icons(images, icons_path):
+    """
+    Encode and hash the decoded icon images for a release, writing the selected icon to `icons_path` immediately and
+    returning compact `model.Icon` descriptors in place of the images themselves.
+    """
+    selected_image = select_icon(images)
+    icons = []
+    for image in images:
+        data = image.data
+        icon = model.Icon(shasum=hashlib.sha256(data).hexdigest(),
+                          width=image.width,
+                          height=image.height,
+                          bpp=image.bpp)
+        if image is selected_image:
+            icon_path = os.path.join(icons_path, icon.filename)
+            exists = os.path.exists(icon_path)
+            report.RUN.cache("icons", exists)
+            if not exists:
+                with open(icon_path, "wb") as fh:
+                    fh.write(data)
+        icons.append(icon)
+    return icons
+
+
+def icon_dict(icon, relative_icons_path, atlases):
+    dict = {
+        'path': os.path.join(relative_icons_path, icon.filename),
+        'width': icon.width,
+        'height': icon.height,
+    }
+    if icon.shasum in atlases:
+        dict['atlas'] = atlases[icon.shasum]
+    return dict
+
+
+def write_icon_atlases(icons_path, relative_icons_path):
+    """
+    Pack the icons in `icons_path` into sprite atlases grouped by size, writing a map from icon hash to atlas and offset
+    alongside them, and returning the same map.
+    """
+    atlases_path = os.path.join(icons_path, ATLASES_DIRECTORY)
+    os.makedirs(atlases_path, exist_ok=True)
+
+    groups = collections.defaultdict(list)
+    for filename in sorted(os.listdir(icons_path)):
+        if not filename.endswith(".gif"):
+            continue
+        with PILImage.open(os.path.join(icons_path, filename)) as image:
+            groups[image.size].append(filename)
+
+    atlases = {}
+    capacity = ATLAS_COLUMNS * ATLAS_COLUMNS
+    for (width, height), filenames in sorted(groups.items()):
+        for atlas_index, start in enumerate(range(0, len(filenames), capacity)):
+            batch = filenames[start:start + capacity]
+            columns = min(ATLAS_COLUMNS, len(batch))
+            rows = math.ceil(len(batch) / columns)
+            atlas_filename = os.path.join(ATLASES_DIRECTORY, f"{width}x{height}-{atlas_index}.png")
+            atlas = PILImage.new("RGBA", (columns * width, rows * height), (0, 0, 0, 0))
+            for index, filename in enumerate(batch):
+                x = (index % columns) * width
+                y = (index // columns) * height
+                with PILImage.open(os.path.join(icons_path, filename)) as image:
+                    atlas.paste(image.convert("RGBA"), (x, y))
+                atlases[os.path.splitext(filename)[0]] = {
+                    'path': os.path.join(relative_icons_path, atlas_filename),
+                    'x': x,
+                    'y': y,
+                }
+            atlas.save(os.path.join(icons_path, atlas_filename), format="PNG", optimize=True)
+
+    with open(os.path.join(atlases_path, "index.json"), "w") as fh:
+        json.dump(atlases, fh)
+    return atlases
+
+
 def group_collections(installers, group_by):
     groups = collections.defaultdict(list)
     for installer in installers:
@@ -381,156 +599,566 @@ def remap_tag(tag):
         return tag
 
 
-def discover_tags(path):
+def tags_for(details):
     tags = set([])
-    with Chdir(path):
-        for f in glob.glob("**/*", recursive=True):
-            if os.path.isdir(f):
-                continue
-            details = opolua.recognize(f)
-            if "era" in details:
-                tags.add(remap_tag(details["era"]))
-            if "type" in details:
-                tags.add(remap_tag(details["type"]))
+    if "era" in details:
+        tags.add(remap_tag(details["era"]))
+    if "type" in details:
+        tags.add(remap_tag(details["type"]))
     if "unknown" in tags:
         tags.remove("unknown")
     return tags
 
 
-def import_installer(source, reference, path):
-    info = opolua.dumpsis(path)
-    icons = []
-    tags = []
-
-    with tempfile.TemporaryDirectory() as temporary_directory_path:
+def discover_tags(path):
+    tags = set([])
+    with Chdir(path):
+        # Files that can't be Psion files are unknown, and contribute no tags, without asking opolua.
+        candidates = [f for f in glob.glob("**/*", recursive=True)
+                      if not os.path.isdir(f) and epoc.is_candidate(f)]
+        for details in opolua.recognize_all(candidates):
+            tags |= tags_for(details)
+    return tags
 
-        with Chdir(temporary_directory_path):
-            opolua.dumpsis_extract(path, temporary_directory_path)
 
-            tags = discover_tags(temporary_directory_path)
+def check_classifier(library):
+    """
+    Check the `epoc` pre-classifier against opolua for every file in the library, including the contents of installers,
+    failing if opolua recognises any file that the classifier would skip (and therefore change the discovered tags).
+    """
+    counts = collections.Counter()
+    mismatches = []
+
+    def check(files):
+        skipped = []
+        for path, description in files:
+            counts['files'] += 1
+            if epoc.is_candidate(path):
+                counts['candidates'] += 1
+            else:
+                skipped.append((path, description))
+        for (path, description), details in zip(skipped, opolua.recognize_all([path for path, _ in skipped])):
+            tags = tags_for(details)
+            if tags:
+                logging.warning("'%s' was skipped by the classifier but recognized as %s.", description, sorted(tags))
+                mismatches.append(description)
 
-            contents = glob.glob("**/*.aif", recursive=True)
-            if contents:
-                aif_path = contents[0]
-                icons = opolua.get_icons(aif_path)
+    for source in library.sources:
+        logging.info("Checking source '%s'...", source.path)
+        assets = [(file_path, asset_key(reference)) for (file_path, reference) in source.assets]
+        check(assets)
+        for file_path, description in assets:
+            if os.path.splitext(file_path)[1].lower() != ".sis":
+                continue
+            with tempfile.TemporaryDirectory() as temporary_directory_path:
+                with Chdir(temporary_directory_path):
+                    try:
+                        opolua.dumpsis_extract(file_path, temporary_directory_path)
+                    except (opolua.InvalidInstaller, opolua.CommandFailed):
+                        continue
+                files = []
+                for root, _, names in os.walk(temporary_directory_path):
+                    for name in names:
+                        path = os.path.join(root, name)
+                        files.append((path, description + "/" + os.path.relpath(path, temporary_directory_path)))
+                check(files)
+
+    logging.info("Checked %d files; %d candidates passed to opolua, %d skipped.",
+                 counts['files'], counts['candidates'], counts['files'] - counts['candidates'])
+    if mismatches:
+        exit(f"Classifier skipped {len(mismatches)} files recognized by opolua.")
+
+
+def import_installer(source, reference, path, sha256, icons_path, readmes_path):
+    installer = opolua.analyze_installer(path)
+    info = installer.info
+    tags = set([])
+    for details in installer.recognize():
+        tags |= tags_for(details)
 
     summary = source.summary_for(path)
-    readme = readme_for(path)
+    readme = readme_for(path, readmes_path=readmes_path)
     return Release(reference=reference,
                    kind=ReleaseKind.INSTALLER,
                    identifier="0x%08x" % info["uid"],
-                   sha256=shasum(path),
+                   sha256=sha256,
                    name=select_name(info["name"]),
                    version=info["version"],
-                   icons=icons,
+                   icons=store_icons(installer.icons, icons_path=icons_path),
                    summary=summary,
                    readme=readme,
                    tags=tags)
 
 
+def import_app(source, reference, path, sha256, icons_path, readmes_path):
+
+    # TODO: Combine APP and SIS.
+
+    name, _ = os.path.splitext(os.path.basename(path))
+    tags = discover_tags(os.path.dirname(path))
+
+    aif_path = find_sibling(path, name + ".aif")
+    uid = sha256
+    icons = []
+    app_name = name
+    if aif_path:
+        info = opolua.dumpaif(aif_path)
+        uid = ("0x%08x" % info["uid3"]).lower()
+        app_name = select_name(info["captions"])
+        icons = opolua.get_icons(aif_path)
+    else:
+        try:
+            info = opolua.dumpaif(path)
+            icons = opolua.get_icons(path)
+            app_name = select_name(info["captions"])
+        except opolua.InvalidAIF:
+            pass
+        except BaseException as e:
+            logging.warning("Failed to parse APP as AIF with message '%s'", e)
+    summary = source.summary_for(path)
+    readme = readme_for(path, readmes_path=readmes_path)
+    return Release(reference=reference,
+                   kind=ReleaseKind.STANDALONE,
+                   identifier=uid,
+                   sha256=sha256,
+                   name=app_name,
+                   version="Unknown",
+                   icons=store_icons(icons, icons_path=icons_path),
+                   summary=summary,
+                   readme=readme,
+                   tags=tags)
+
+
+def asset_key(reference):
+    return "/".join(item.name for item in reference)
+
+
 # TODO: Rename to just import?
-def import_source(source, reference=None, path=None, indent=0):
+def import_source(source, icons_path, readmes_path, quarantine, release_log, selection=None, reference=None,
+                  path=None, indent=0):
 
     apps = []
+    ordinal = 0
     logging.info(" " * indent + f"Importing source '{source.path}'...")
     for (file_path, reference) in source.assets:
-        basename = os.path.basename(file_path)
-        name, ext = os.path.splitext(basename)
-        ext = ext.lower()
+        ext = os.path.splitext(file_path)[1].lower()
 
         # TODO: See if this is now fixed with Tom's new detection stuff.
-        if basename in IGNORED or "System/Install" in file_path:
+        if "System/Install" in file_path:
             continue
 
         if ext == ".app" or ext == ".opa":
+            importer, description = import_app, "app"
+        elif ext == ".sis":
+            importer, description = import_installer, "installer"
+        else:
+            continue
 
-            # TODO: Combine APP and SIS.
-
-            tags = discover_tags(os.path.dirname(file_path))
+        # Every asset is numbered in walk order, even if it has already been imported, so re-imported assets keep their
+        # position.
+        ordinal += 1
 
-            logging.info(" " * indent + f"Importing app '{file_path}'...")
-            aif_path = find_sibling(file_path, name + ".aif")
-            uid = shasum(file_path)
-            icons = []
-            app_name = name
-            if aif_path:
-                info = opolua.dumpaif(aif_path)
-                uid = ("0x%08x" % info["uid3"]).lower()
-                app_name = select_name(info["captions"])
-                icons = opolua.get_icons(aif_path)
-            else:
-                try:
-                    info = opolua.dumpaif(file_path)
-                    icons = opolua.get_icons(file_path)
-                    app_name = select_name(info["captions"])
-                except opolua.InvalidAIF:
-                    pass
-                except BaseException as e:
-                    logging.warning("Failed to parse APP as AIF with message '%s'", e)
-            summary = source.summary_for(file_path)
-            readme = readme_for(file_path)
-            release = Release(reference=reference,
-                              kind=ReleaseKind.STANDALONE,
-                              identifier=uid,
-                              sha256=shasum(file_path),
-                              name=app_name,
-                              version="Unknown",
-                              icons=icons,
-                              summary=summary,
-                              readme=readme,
-                              tags=tags)
-            apps.append(release)
+        # Assets recorded in the release log by an earlier, interrupted, index have already been imported. When a
+        # selection is given, selected assets are always re-imported, replacing their entries in the log, and all other
+        # assets are left as they are.
+        asset = asset_key(reference)
+        if selection is not None:
+            if not selection.includes_asset(asset, release_log.records_for(source.path, asset)):
+                continue
+        else:
+            imported = release_log.contains(source.path, asset)
+            report.RUN.cache("release-log", imported)
+            if imported:
+                continue
 
-        elif ext == ".sis":
+        # Files that previously caused opolua to fail or time out are skipped until opolua is updated, unless they've
+        # been explicitly selected.
+        sha256 = shasum(file_path)
+        if quarantine.contains(sha256) and selection is None:
+            logging.info(" " * indent + f"Skipping quarantined {description} '{file_path}'...")
+            continue
 
-            logging.info(" " * indent + f"Importing installer '{file_path}'...")
-            try:
-                apps.append(import_installer(source=source, reference=reference, path=file_path))
-            except opolua.InvalidInstaller as e:
-                logging.error("Failed to import installer with message '%s", e)
+        logging.info(" " * indent + f"Importing {description} '{file_path}'...")
+        report.RUN.asset()
+        try:
+            release = importer(source=source,
+                               reference=reference,
+                               path=file_path,
+                               sha256=sha256,
+                               icons_path=icons_path,
+                               readmes_path=readmes_path)
+        except opolua.InvalidInstaller as e:
+            logging.error("Failed to import installer with message '%s", e)
+            release_log.add_asset(source.path, asset, ordinal, [])
+            continue
+        except opolua.CommandFailed as e:
+            logging.warning("Quarantining '%s' with message '%s'.", file_path, e)
+            quarantine.add(sha256, file_path, str(e))
+            # Record the failure so that any releases from a previous index (e.g., when re-importing a selection) are
+            # replaced rather than kept.
+            release_log.add_asset(source.path, asset, ordinal, [])
+            continue
+        quarantine.discard(sha256)
+        release_log.add_asset(source.path, asset, ordinal, [release.as_record()])
+        apps.append(release)
 
     return apps
 
 
-def index(library):
+def summary_contribution(releases):
+    """
+    Return the contribution of `releases` to the library summary, in a form that can be combined with the contributions
+    of other shards.
+    """
+    return {
+        'installerCount': len(releases),
+        'uids': sorted(set([release.uid for release in releases])),
+        'versions': sorted(set([(release.uid, release.version) for release in releases])),
+        'shas': sorted(set([release.sha256 for release in releases])),
+    }
+
+
+def merge_summary_contributions(contributions):
+    return Summary(installer_count=sum([contribution['installerCount'] for contribution in contributions]),
+                   uid_count=len(set([uid for contribution in contributions for uid in contribution['uids']])),
+                   version_count=len(set([tuple(version)
+                                          for contribution in contributions
+                                          for version in contribution['versions']])),
+                   sha_count=len(set([sha for contribution in contributions for sha in contribution['shas']])))
+
+
+def fragments_directory(library):
+    return os.path.join(library.state_directory, "fragments")
+
+
+def index(library, resume=False, aggregate_only=False, shard=None, background_sync=None, selection=None):
+    """
+    Import all the sources in `library` and write the index. Each imported asset is recorded in an append-only release
+    log so that an interrupted index can be continued with `resume`, and `aggregate_only` regenerates the index outputs
+    from the log alone without importing anything.
+
+    If `shard` is given, only the sources assigned to that shard are imported, and a self-contained fragment (release
+    log, icons, and summary contribution) is written to the fragments directory for a later `merge`.
+
+    If `background_sync` is given, each source is imported as soon as it has been synced. Sources are still imported in
+    library order to keep the index identical to a sequential run.
+
+    If `selection` is given, only the selected assets are re-imported, and their releases are spliced into those of the
+    previous index in the release log before the index outputs are regenerated.
+    """
+
+    if selection is not None:
+        index_selection(library, selection, background_sync=background_sync)
+        return
+
+    if shard is not None and shard.count == 1:
+        shard = None
+    if shard is None:
+        release_log_path = os.path.join(library.state_directory, "releases.jsonl")
+        icons_path = os.path.join(library.index_directory, "icons")
+        readmes_path = os.path.join(library.index_directory, READMES_DIRECTORY)
+    else:
+        fragment_path = os.path.join(fragments_directory(library), shard.name)
+        release_log_path = os.path.join(fragment_path, "releases.jsonl")
+        icons_path = os.path.join(fragment_path, "icons")
+        readmes_path = os.path.join(fragment_path, READMES_DIRECTORY)
+
+    # Create the icons and readmes directories; icons and readmes are written as each release is imported to avoid
+    # holding them in memory for the duration of the index. Those from an earlier run are kept when resuming as the
+    # release log refers to them.
+    for directory_path in [icons_path, readmes_path]:
+        if os.path.exists(directory_path) and not (resume or aggregate_only):
+            shutil.rmtree(directory_path)
+        os.makedirs(directory_path, exist_ok=True)
+
+    if aggregate_only:
+        if not os.path.exists(release_log_path):
+            exit(f"No release log found at '{release_log_path}'; run a full index first.")
+        release_log = checkpoint.ReleaseLog(release_log_path, read_only=True)
+        releases = [Release.from_record(record) for _, record in release_log.releases]
+    else:
+        sources = shard.select(library.sources) if shard is not None else library.sources
+        problem_files = quarantine.Quarantine(os.path.join(library.state_directory, "quarantine.json"),
+                                              opolua.version())
+
+        # Import all the standalone apps and installers, starting with any already recorded in the release log.
+        with checkpoint.ReleaseLog(release_log_path, resume=resume) as release_log:
+            releases = [Release.from_record(record) for _, record in release_log.releases]
+            for source in sources:
+                if release_log.is_complete(source.path):
+                    logging.info("Skipping imported source '%s'...", source.path)
+                    continue
+                if background_sync is not None:
+                    background_sync.wait(source)
+                with report.RUN.stage("index " + os.path.relpath(source.path, library.assets_directory)):
+                    releases += import_source(source,
+                                              icons_path=icons_path,
+                                              readmes_path=readmes_path,
+                                              quarantine=problem_files,
+                                              release_log=release_log)
+                release_log.complete(source.path)
+        if problem_files.added:
+            logging.warning("%d files quarantined; run the 'quarantine' command for details.", len(problem_files.added))
+
+    # Shards only write their summary contribution; the index itself is written by `merge`.
+    if shard is not None and shard.count > 1:
+        fragment_summary_path = os.path.join(fragment_path, "summary.json")
+        logging.info("Writing fragment summary '%s'...", fragment_summary_path)
+        with open(fragment_summary_path, "w") as fh:
+            json.dump({
+                'shard': {'index': shard.index, 'count': shard.count},
+                'contribution': summary_contribution(releases),
+            }, fh)
+        return
+
+    with report.RUN.stage("index aggregate"):
+        write_index(library, releases)
+
+
+def index_selection(library, selection, background_sync=None):
+    release_log_path = os.path.join(library.state_directory, "releases.jsonl")
+    icons_path = os.path.join(library.index_directory, "icons")
+    readmes_path = os.path.join(library.index_directory, READMES_DIRECTORY)
+    if not os.path.exists(release_log_path):
+        exit(f"No release log found at '{release_log_path}'; run a full index first.")
+
+    problem_files = quarantine.Quarantine(os.path.join(library.state_directory, "quarantine.json"), opolua.version())
+    with checkpoint.ReleaseLog(release_log_path, resume=True) as release_log:
+        for source in library.sources:
+            # Re-imported assets keep their ordinals as each source is walked in the same order; other sources are left
+            # untouched.
+            if selection.includes_source(source):
+                if background_sync is not None:
+                    background_sync.wait(source)
+                with report.RUN.stage("index " + os.path.relpath(source.path, library.assets_directory)):
+                    import_source(source,
+                                  icons_path=icons_path,
+                                  readmes_path=readmes_path,
+                                  quarantine=problem_files,
+                                  release_log=release_log,
+                                  selection=selection)
+        releases = [Release.from_record(record) for _, record in release_log.releases]
+
+    # Remove the icons and readmes that are no longer used by any release, keeping the index consistent with a full run.
+    icons = set([release.icon.filename for release in releases if release.icon is not None])
+    readmes = set([release.readme.filename for release in releases if release.readme is not None])
+    for directory_path, extension, filenames in [(icons_path, ".gif", icons), (readmes_path, ".txt", readmes)]:
+        for filename in os.listdir(directory_path):
+            if filename.endswith(extension) and filename not in filenames:
+                os.remove(os.path.join(directory_path, filename))
+
+    with report.RUN.stage("index aggregate"):
+        write_index(library, releases)
+
+
+def stage_name(name, library, libraries):
+    # Stages are qualified by library in multi-library builds, keeping single-library reports comparable.
+    return name if len(libraries) == 1 else f"{name} {os.path.basename(library.path)}"
+
+
+def index_libraries(libraries, resume=False, aggregate_only=False, background_sync=None):
+    """
+    Index several libraries in a single analysis pass. Each distinct source (by URL) is imported once, into a release
+    log, icons, and readmes shared by the libraries and kept in the first library's state directory, and each library's
+    index is then written from the releases of its own sources, producing the same output as indexing it on its own.
+    """
+    analysis_path = os.path.join(libraries[0].state_directory, "analysis")
+    release_log_path = os.path.join(analysis_path, "releases.jsonl")
+    icons_path = os.path.join(analysis_path, "icons")
+    readmes_path = os.path.join(analysis_path, READMES_DIRECTORY)
+    sources = common.distinct_sources(libraries)
+
+    for directory_path in [icons_path, readmes_path]:
+        if os.path.exists(directory_path) and not (resume or aggregate_only):
+            shutil.rmtree(directory_path)
+        os.makedirs(directory_path, exist_ok=True)
+
+    if aggregate_only:
+        if not os.path.exists(release_log_path):
+            exit(f"No release log found at '{release_log_path}'; run a full index first.")
+        release_log = checkpoint.ReleaseLog(release_log_path, read_only=True)
+    else:
+        problem_files = quarantine.Quarantine(os.path.join(libraries[0].state_directory, "quarantine.json"),
+                                              opolua.version())
+        with checkpoint.ReleaseLog(release_log_path, resume=resume) as release_log:
+            for source in sources:
+                if release_log.is_complete(source.path):
+                    logging.info("Skipping imported source '%s'...", source.path)
+                    continue
+                if background_sync is not None:
+                    background_sync.wait(source)
+                with report.RUN.stage("index " + os.path.relpath(source.path, os.path.dirname(source.item_directory))):
+                    import_source(source,
+                                  icons_path=icons_path,
+                                  readmes_path=readmes_path,
+                                  quarantine=problem_files,
+                                  release_log=release_log)
+                release_log.complete(source.path)
+        if problem_files.added:
+            logging.warning("%d files quarantined; run the 'quarantine' command for details.", len(problem_files.added))
+
+    # Fan the releases out to the libraries, copying just the icons and readmes each one uses into its index.
+    shared_sources = {source.url: source for source in sources}
+    for library in libraries:
+        records = [record
+                   for source in library.sources
+                   for _, record in sorted(release_log.releases_for(shared_sources[source.url].path),
+                                           key=lambda x: x[0])]
+        releases = [Release.from_record(record) for record in records]
+        library_icons_path = os.path.join(library.index_directory, "icons")
+        library_readmes_path = os.path.join(library.index_directory, READMES_DIRECTORY)
+        for directory_path in [library_icons_path, library_readmes_path]:
+            if os.path.exists(directory_path):
+                shutil.rmtree(directory_path)
+            os.makedirs(directory_path)
+        for release in releases:
+            blobs = []
+            if release.icon is not None:
+                blobs.append((icons_path, library_icons_path, release.icon.filename))
+            if release.readme is not None:
+                blobs.append((readmes_path, library_readmes_path, release.readme.filename))
+            for source_directory, destination_directory, filename in blobs:
+                source_path = os.path.join(source_directory, filename)
+                destination_path = os.path.join(destination_directory, filename)
+                if os.path.exists(source_path) and not os.path.exists(destination_path):
+                    shutil.copyfile(source_path, destination_path)
+        with report.RUN.stage(stage_name("index aggregate", library, libraries)):
+            write_index(library, releases)
+
+
+def merge(library):
+    """
+    Combine the fragments written by `index --shard i/n` into the index, producing the same output as a single-machine
+    index of the library.
+    """
+    icons_path = os.path.join(library.index_directory, "icons")
+    readmes_path = os.path.join(library.index_directory, READMES_DIRECTORY)
+
+    # Load and check the fragment summaries; every shard needs to be present and complete.
+    fragments = {}
+    path = fragments_directory(library)
+    for name in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+        summary_path = os.path.join(path, name, "summary.json")
+        if not os.path.exists(summary_path):
+            logging.warning("Ignoring incomplete fragment '%s'.", name)
+            continue
+        with open(summary_path) as fh:
+            fragment = json.load(fh)
+        fragments[(fragment['shard']['index'], fragment['shard']['count'])] = (os.path.join(path, name), fragment)
+    counts = set([count for _, count in fragments.keys()])
+    if len(counts) != 1:
+        exit(f"Expected fragments from a single sharded index in '{path}' but found shard counts {sorted(counts)}.")
+    count = counts.pop()
+    missing = [str(index) for index in range(1, count + 1) if (index, count) not in fragments]
+    if missing:
+        exit(f"Missing fragments for shards {', '.join(missing)} of {count}.")
+
+    # Copy the icons and readmes, and collect the releases, restoring the single-machine ordering.
+    for directory_path in [icons_path, readmes_path]:
+        if os.path.exists(directory_path):
+            shutil.rmtree(directory_path)
+        os.makedirs(directory_path)
+    release_logs = []
+    contributions = []
+    for key in sorted(fragments.keys()):
+        fragment_path, fragment = fragments[key]
+        logging.info("Merging fragment '%s'...", fragment_path)
+        fragment_icons_path = os.path.join(fragment_path, "icons")
+        for filename in os.listdir(fragment_icons_path):
+            if filename.endswith(".gif"):
+                shutil.copyfile(os.path.join(fragment_icons_path, filename), os.path.join(icons_path, filename))
+        fragment_readmes_path = os.path.join(fragment_path, READMES_DIRECTORY)
+        for filename in os.listdir(fragment_readmes_path):
+            shutil.copyfile(os.path.join(fragment_readmes_path, filename), os.path.join(readmes_path, filename))
+        release_logs.append(checkpoint.ReleaseLog(os.path.join(fragment_path, "releases.jsonl"), read_only=True))
+        contributions.append(fragment['contribution'])
+
+    # Shards import whole sources, so the single-machine order is the library order of the sources, and then the walk
+    # order of the assets within each source.
+    releases = []
+    for source_path in dict.fromkeys([source.path for source in library.sources]):
+        records = [item for release_log in release_logs for item in release_log.releases_for(source_path)]
+        releases += [Release.from_record(record) for _, record in sorted(records, key=lambda x: x[0])]
+
+    with report.RUN.stage("merge aggregate"):
+        summary = write_index(library, releases)
+    expected_summary = merge_summary_contributions(contributions)
+    if summary.as_dict() != expected_summary.as_dict():
+        exit(f"Merged summary {summary.as_dict()} doesn't match the fragment summaries {expected_summary.as_dict()}.")
+
+
+RELEASE_TABLE_STRING = pa.dictionary(pa.int32(), pa.string())
+
+RELEASE_TABLE_SCHEMA = pa.schema([
+    ('uid', RELEASE_TABLE_STRING),
+    ('sha256', RELEASE_TABLE_STRING),
+    ('name', RELEASE_TABLE_STRING),
+    ('version', RELEASE_TABLE_STRING),
+    ('kind', RELEASE_TABLE_STRING),
+    ('tags', pa.list_(RELEASE_TABLE_STRING)),
+    ('source', RELEASE_TABLE_STRING),
+    ('reference', pa.string()),
+    ('icon', RELEASE_TABLE_STRING),
+    ('icon_width', pa.uint16()),
+    ('icon_height', pa.uint16()),
+    ('icon_bpp', pa.uint8()),
+    ('icon_count', pa.uint16()),
+])
+
+
+def write_release_table(path, releases):
+    """
+    Write a flat table of `releases`, one row per release, for analysis. The table is an uncompressed Arrow IPC
+    (Feather) file so it can be memory-mapped by `pyarrow.feather.read_table`, or read by any Arrow-aware tool.
+    """
+    feather.write_feather(pa.table({
+        'uid': [release.uid for release in releases],
+        'sha256': [release.sha256 for release in releases],
+        'name': [release.name for release in releases],
+        'version': [release.version for release in releases],
+        'kind': [release.kind.value for release in releases],
+        'tags': [sorted(list(release.tags)) for release in releases],
+        'source': [release.reference[0].url if release.reference else None for release in releases],
+        'reference': [asset_key(release.reference) for release in releases],
+        'icon': [release.icon.shasum if release.icon else None for release in releases],
+        'icon_width': [release.icon.width if release.icon else 0 for release in releases],
+        'icon_height': [release.icon.height if release.icon else 0 for release in releases],
+        'icon_bpp': [release.icon.bpp if release.icon else 0 for release in releases],
+        'icon_count': [len(release.icons) for release in releases],
+    }, schema=RELEASE_TABLE_SCHEMA), path, compression="uncompressed")
+
+
+def summary_for_table(releases):
+    return Summary(installer_count=releases.num_rows,
+                   uid_count=pc.count_distinct(releases['uid'].cast(pa.string())).as_py(),
+                   version_count=releases.group_by(['uid', 'version']).aggregate([]).num_rows,
+                   sha_count=pc.count_distinct(releases['sha256'].cast(pa.string())).as_py())
+
+
+def write_index(library, releases):
 
     summary_path = os.path.join(library.index_directory, "summary.json")
+    releases_table_path = os.path.join(library.index_directory, "releases.feather")
     sources_path = os.path.join(library.index_directory, "sources.json")
     programs_path = os.path.join(library.index_directory, "programs.json")
     icons_path = os.path.join(library.index_directory, "icons")
 
-    # Import all the standalone apps and installers.
-    releases = []
-    for source in library.sources:
-        releases += import_source(source)
-
-    # Generate the library summary.
-    unique_uids = set()
-    unique_versions = set()
-    unique_shas = set()
-    total_count = 0
-    details = collections.defaultdict(list)
+    # Group the releases by identifier/uid. Programs are ordered by name, so the groups (lists of the releases, which
+    # are already in memory) are needed up-front, but each program is only created as it's written.
     groups = collections.defaultdict(list)
     for release in releases:
-        unique_uids.add(release.uid)
-        unique_versions.add((release.uid, release.version))
-        unique_shas.add(release.sha256)
-        total_count = total_count + 1
-        details[(release.uid, release.sha256, release.version)].append(release)
         groups[(release.uid)].append(release)
-    summary = Summary(installer_count=total_count,
-                      uid_count=len(unique_uids),
-                      version_count=len(unique_versions),
-                      sha_count=len(unique_shas))
+    applications = (Program(identifier, installers, [])
+                    for identifier, installers in sorted(groups.items(), key=lambda x: x[1][0].name.lower()))
 
-    # Generate the library by grouping the programs together by identifier/uid.
-    applications = []
-    for identifier, installers in sorted([item for item in groups.items()],
-                                         key=lambda x: x[1][0].name.lower()):
-        applications.append(Program(identifier, installers, []))
+    # Pack the icons into sprite atlases.
+    logging.info("Writing icon atlases...")
+    atlases = write_icon_atlases(icons_path, relative_icons_path="icons")
 
-    # Create the output directory.
-    os.makedirs(library.index_directory, exist_ok=True)
+    # Write the release table, and generate the library summary from it.
+    logging.info("Writing release table '%s'...", releases_table_path)
+    write_release_table(releases_table_path, releases)
+    summary = summary_for_table(feather.read_table(releases_table_path, memory_map=True))
 
     # Write the summary.
     logging.info("Writing summary '%s'...", summary_path)
@@ -542,35 +1170,56 @@ def index(library):
     with open(sources_path, "w") as fh:
         json.dump([source.as_dict() for source in library.sources], fh)
 
-    # Write the library.
+    # Write the library, one program at a time.
     logging.info("Writing the library '%s'...", programs_path)
-    with open(programs_path, "w", encoding="utf-8") as fh:
-        json.dump([application.as_dict(relative_icons_path="icons") for application in applications], fh)
-
-    # Iterate over all the individual standalone app and installer instances and write the assets to disk.
-    if os.path.exists(icons_path):
-        shutil.rmtree(icons_path)
-    os.makedirs(icons_path)
-    for release in releases:
-        release.write_assets(icons_path=icons_path)
-
-
-def overlay(library):
+    stream.write_array(programs_path, (application.as_dict(relative_icons_path="icons", atlases=atlases)
+                                       for application in applications))
+
+    return summary
+
+
+def copy_screenshots(library, identifier, screenshots, screenshots_output_path):
+    os.makedirs(os.path.join(screenshots_output_path, identifier))
+    relative_paths = []
+    for screenshot in screenshots:
+        relative_path = os.path.join("screenshots", identifier, os.path.basename(screenshot))
+        destination_path = os.path.join(library.output_directory, relative_path)
+        logging.info("Copying '%s' to '%s'...", screenshot, destination_path)
+        shutil.copyfile(screenshot, destination_path)
+        with PILImage.open(screenshot) as image:
+            width, height = image.size
+        relative_paths.append({
+            "width": width,
+            "height": height,
+            "path": relative_path,
+        })
+    return relative_paths
+
+
+def overlay(library, selection=None):
+    """
+    Merge the overlay into the index, writing the site data and API to the library's output directory. If `selection`
+    is given, screenshots are only copied for the selected programs, with the other programs keeping the screenshots
+    from the previous overlay.
+    """
     logging.info("Applying overlay...")
 
     source_programs_path = os.path.join(library.index_directory, "programs.json")
     source_sources_path = os.path.join(library.index_directory, "sources.json")
     source_summary_path = os.path.join(library.index_directory, "summary.json")
     icons_path = os.path.join(library.index_directory, "icons")
+    readmes_path = os.path.join(library.index_directory, READMES_DIRECTORY)
 
     data_output_path = os.path.join(library.output_directory, "_data")
     screenshots_output_path = os.path.join(library.output_directory, "screenshots")
     icons_output_path = os.path.join(library.output_directory, "icons")
+    readmes_output_path = os.path.join(library.output_directory, READMES_DIRECTORY)
     api_v1_output_path = os.path.join(library.output_directory, "api", "v1")
 
     destination_programs_path = os.path.join(data_output_path, "programs.json")
     destination_sources_path = os.path.join(data_output_path, "sources.json")
     destination_summary_path = os.path.join(data_output_path, "summary.json")
+    changes_path = os.path.join(library.state_directory, "changes")
 
     # Import screenshots and metadata from the overlay.
     overlay = collections.defaultdict(dict)
@@ -586,17 +1235,27 @@ def overlay(library):
             if os.path.exists(overlay_index_path):
                 overlay[identifier]["index"] = frontmatter.load(overlay_index_path)
 
-    # Load the index.
-    with open(source_programs_path) as fh:
-        index = json.load(fh)
+    # Keep the screenshots of the programs that aren't selected.
+    previous_screenshots = None
+    if selection is not None:
+        if os.path.exists(destination_programs_path):
+            previous_screenshots = {application['uid']: application['screenshots']
+                                    for application in stream.read_array(destination_programs_path)
+                                    if 'screenshots' in application}
+        else:
+            logging.warning("No previous overlay found; applying the overlay to all programs.")
+    selected_source_urls = set([source.url for source in library.sources
+                                if selection is not None and selection.includes_source(source)])
 
     # Clean up the destination paths.
-    if os.path.exists(screenshots_output_path):
+    if os.path.exists(screenshots_output_path) and previous_screenshots is None:
         shutil.rmtree(screenshots_output_path)
     if os.path.exists(data_output_path):
         shutil.rmtree(data_output_path)
     if os.path.exists(icons_output_path):
         shutil.rmtree(icons_output_path)
+    if os.path.exists(readmes_output_path):
+        shutil.rmtree(readmes_output_path)
     if os.path.exists(api_v1_output_path):
         shutil.rmtree(api_v1_output_path)
 
@@ -604,40 +1263,44 @@ def overlay(library):
     os.makedirs(data_output_path, exist_ok=True)
     os.makedirs(screenshots_output_path, exist_ok=True)
 
-    # Merge the overlay into the index.
-    for application in index:
-        identifier = application['uid']
-        if identifier not in overlay:
-            continue
-        screenshots = overlay[identifier]["screenshots"] if "screenshots" in overlay[identifier] else []
-        os.makedirs(os.path.join(screenshots_output_path, identifier))
-        relative_paths = []
-        for screenshot in screenshots:
-            relative_path = os.path.join("screenshots", identifier, os.path.basename(screenshot))
-            destination_path = os.path.join(library.output_directory, relative_path)
-            logging.info("Copying '%s' to '%s'...", screenshot, destination_path)
-            shutil.copyfile(screenshot, destination_path)
-            with PILImage.open(screenshot) as image:
-                width, height = image.size
-            relative_paths.append({
-                "width": width,
-                "height": height,
-                "path": relative_path,
-            })
-        application['screenshots'] = relative_paths
+    # Merge the overlay into the index, streaming the programs from the index to the output one at a time, and
+    # recording the changes since the previous build as we go.
+    current_snapshot = changes.Snapshot()
+
+    def programs():
+        for application in stream.read_array(source_programs_path):
+            identifier = application['uid']
+            if previous_screenshots is not None and not selection.includes_program(application, selected_source_urls):
+                if identifier in previous_screenshots:
+                    application['screenshots'] = previous_screenshots[identifier]
+            elif identifier in overlay:
+                shutil.rmtree(os.path.join(screenshots_output_path, identifier), ignore_errors=True)
+                application['screenshots'] = copy_screenshots(library,
+                                                              identifier,
+                                                              overlay[identifier].get("screenshots", []),
+                                                              screenshots_output_path)
+            current_snapshot.add(application)
+            yield application
 
     # Write the index.
     shutil.copyfile(source_sources_path, destination_sources_path)
     shutil.copyfile(source_summary_path, destination_summary_path)
-    with open(destination_programs_path, "w") as fh:
-        json.dump(index, fh)
+    program_count = stream.write_array(destination_programs_path, programs())
+
+    # Record the changes since the previous build.
+    change_log = changes.ChangeLog(changes_path)
+    change_log.record(current_snapshot)
 
     # Copy the icons.
     shutil.copytree(icons_path, icons_output_path)
 
+    # Copy the readmes.
+    shutil.copytree(readmes_path, readmes_output_path)
+
     # Copy the API.
     os.makedirs(api_v1_output_path, exist_ok=True)
     shutil.copytree(icons_output_path, os.path.join(api_v1_output_path, "icons"))
+    shutil.copytree(readmes_output_path, os.path.join(api_v1_output_path, READMES_DIRECTORY))
     shutil.copytree(screenshots_output_path, os.path.join(api_v1_output_path, "screenshots"))
     os.makedirs(os.path.join(api_v1_output_path, "programs"), exist_ok=True)
     shutil.copyfile(destination_programs_path, os.path.join(api_v1_output_path, "programs", "index.json"))
@@ -646,22 +1309,156 @@ def overlay(library):
     os.makedirs(os.path.join(api_v1_output_path, "summary"), exist_ok=True)
     shutil.copyfile(destination_summary_path, os.path.join(api_v1_output_path, "summary", "index.json"))
 
+    # Write the compact binary encoding of the API alongside the JSON.
+    logging.info("Writing binary API...")
+    packed.write_programs(destination_programs_path,
+                          program_count,
+                          os.path.join(api_v1_output_path, "programs", "index" + packed.EXTENSION))
+    with open(destination_sources_path) as fh:
+        packed.write_sources(json.load(fh), os.path.join(api_v1_output_path, "sources", "index" + packed.EXTENSION))
+    with open(destination_summary_path) as fh:
+        packed.write_summary(json.load(fh), os.path.join(api_v1_output_path, "summary", "index" + packed.EXTENSION))
+    change_log.publish(os.path.join(api_v1_output_path, "changes"))
+
+
+def render_pages(library):
+    programs = stream.read_array(os.path.join(library.output_directory, "_data", "programs.json"))
+    render.render(programs,
+                  site_directory=library.output_directory,
+                  state_path=os.path.join(library.state_directory, "render.json"))
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--verbose', '-v', action='store_true', default=False, help="show verbose output")
-    parser.add_argument("definition")
-    parser.add_argument("command", choices=["sync", "index", "overlay"], nargs="+", help="command to run")
-    options = parser.parse_args()
-
-    library = common.Library(options.definition)
+    parser.add_argument('--timeout', type=int, default=opolua.LIMITS.timeout,
+                        help="maximum time in seconds for each opolua invocation")
+    parser.add_argument('--cpu-limit', type=int, default=opolua.LIMITS.cpu,
+                        help="maximum CPU time in seconds for each opolua invocation")
+    parser.add_argument('--memory-limit', type=int, default=opolua.LIMITS.memory,
+                        help="maximum address space in bytes for each opolua invocation")
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help="continue an interrupted index from the release log")
+    parser.add_argument('--aggregate-only', action='store_true', default=False,
+                        help="regenerate the index outputs from the release log without importing any sources")
+    parser.add_argument('--shard', type=parse_shard, default=None,
+                        help="only index shard i of n (e.g., 2/4), writing a fragment for a later 'merge'")
+    parser.add_argument('--pipeline', action='store_true', default=False,
+                        help="when running 'sync' and 'index' together, index each source as soon as it is synced")
+    parser.add_argument('--sync-jobs', type=int, default=common.SYNC_JOBS,
+                        help="number of sources to sync concurrently when pipelining (default %(default)s)")
+    parser.add_argument('--refresh-interval', type=float, default=None,
+                        help="hours after which 'sync' revalidates downloaded metadata and assets with conditional "
+                             "requests (default from the library, or %d)" % common.REFRESH_INTERVAL)
+    parser.add_argument('--source', action='append', default=None,
+                        help="only index or overlay the given source (Internet Archive identifier); may be repeated")
+    parser.add_argument('--uid', action='append', default=None,
+                        help="only index or overlay the program with the given UID (e.g., 0x10000357); may be repeated")
+    parser.add_argument('--path-glob', action='append', default=None,
+                        help="only index or overlay assets whose path within their source matches the glob; may be "
+                             "repeated")
+    parser.add_argument('--compare', action='store_true', default=False,
+                        help="compare the latest performance report against the recent runs, failing on regressions")
+    parser.add_argument('--threshold', type=float, default=report.THRESHOLD,
+                        help="fractional change in a stage metric considered a regression (default %(default)s)")
+    parser.add_argument("definition", nargs="+",
+                        help="library definition; several libraries can be built together, sharing one analysis pass")
+    parser.add_argument("command", choices=COMMANDS, nargs="+", help="command to run")
+    options = parser.parse_intermixed_args()
+
+    # Both the definitions and the commands are variadic, so argparse hands all but the last command to the
+    # definitions; move them back.
+    definition_count = next((i for i, definition in enumerate(options.definition) if definition in COMMANDS),
+                            len(options.definition))
+    options.command = options.definition[definition_count:] + options.command
+    options.definition = options.definition[:definition_count]
+    if not options.definition:
+        parser.error("at least one library definition is required")
+    if len(options.definition) > 1 and options.shard is not None:
+        parser.error("--shard can only be used with a single library")
+    selection = None
+    if options.source or options.uid or options.path_glob:
+        selection = Selection(sources=options.source, uids=options.uid, path_globs=options.path_glob)
+        if "index" in options.command and (len(options.definition) > 1 or options.shard is not None
+                                           or options.aggregate_only):
+            parser.error("--source, --uid, and --path-glob can't be used with --shard, --aggregate-only, or "
+                         "several libraries when indexing")
+
+    opolua.LIMITS = opolua.Limits(timeout=options.timeout, cpu=options.cpu_limit, memory=options.memory_limit)
+    libraries = [common.Library(definition) for definition in options.definition]
+    for library in libraries:
+        if options.refresh_interval is not None:
+            library.refresh_interval = options.refresh_interval
+
+    # The first library holds the state shared by a multi-library build, including the performance reports.
+    reports_path = os.path.join(libraries[0].state_directory, "reports")
+    sources = common.distinct_sources(libraries)
+    refresh_interval = min([library.refresh_interval for library in libraries])
+    pipeline = options.pipeline and "sync" in options.command and "index" in options.command
+    background_sync = None
 
     for command in options.command:
         if command == "sync":
-            library.sync()
+            sync_sources = sources
+            if options.shard is not None:
+                # Shards are assigned using the file metadata of every source, but only download their own sources.
+                for source in sources:
+                    source.sync_metadata(refresh_interval=refresh_interval)
+                sync_sources = options.shard.select(sources)
+            if pipeline:
+                background_sync = common.BackgroundSync(sync_sources, jobs=options.sync_jobs,
+                                                        refresh_interval=refresh_interval)
+            else:
+                common.sync(sync_sources, refresh_interval=refresh_interval)
+        if command == "verify":
+            results = [library.verify() for library in libraries]
+            if not all(results):
+                exit(1)
         if command == "index":
-            index(library)
+            try:
+                if len(libraries) == 1:
+                    index(libraries[0],
+                          resume=options.resume,
+                          aggregate_only=options.aggregate_only,
+                          shard=options.shard,
+                          background_sync=background_sync,
+                          selection=selection)
+                else:
+                    index_libraries(libraries,
+                                    resume=options.resume,
+                                    aggregate_only=options.aggregate_only,
+                                    background_sync=background_sync)
+            except BaseException:
+                if background_sync is not None:
+                    background_sync.cancel()
+                raise
+            if background_sync is not None:
+                background_sync.join()
+                background_sync = None
+        if command == "merge":
+            for library in libraries:
+                merge(library)
         if command == "overlay":
-            overlay(library)
+            for library in libraries:
+                with report.RUN.stage(stage_name("overlay", library, libraries)):
+                    overlay(library, selection=selection)
+        if command == "render":
+            for library in libraries:
+                with report.RUN.stage(stage_name("render", library, libraries)):
+                    render_pages(library)
+        if command == "quarantine":
+            quarantine.Quarantine(os.path.join(libraries[0].state_directory, "quarantine.json"),
+                                  opolua.version()).report()
+        if command == "check-classifier":
+            for library in libraries:
+                check_classifier(library)
+        if command == "report":
+            report.report(reports_path, compare_baseline=options.compare, threshold=options.threshold)
+
+    # Keep a history of the performance of runs that do substantial work.
+    commands = [command for command in options.command if command in ["index", "merge", "overlay", "render"]]
+    if commands:
+        report.RUN.save(reports_path, commands)
 
 
 if __name__ == "__main__":
@@ -23,6 +23,8 @@
 
 class Collection(object):
 
+    __slots__ = ('identifier', 'items')
+
     def __init__(self, identifier, items):
         self.identifier = identifier
         self.items = items
@@ -34,8 +36,39 @@ class Collection(object):
         }
 
 
+class Icon(object):
+
+    __slots__ = ('shasum', 'width', 'height', 'bpp')
+
+    def __init__(self, shasum, width, height, bpp):
+        self.shasum = shasum
+        self.width = width
+        self.height = height
+        self.bpp = bpp
+
+    @property
+    def filename(self):
+        return self.shasum + ".gif"
+
+
+class Readme(object):
+
+    __slots__ = ('sha256', 'size', 'excerpt')
+
+    def __init__(self, sha256, size, excerpt):
+        self.sha256 = sha256
+        self.size = size
+        self.excerpt = excerpt
+
+    @property
+    def filename(self):
+        return self.sha256 + ".txt"
+
+
 class ReferenceItem(object):
 
+    __slots__ = ('name', 'url')
+
     def __init__(self, name, url):
         self.name = name
         self.url = url
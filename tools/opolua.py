@@ -25,13 +25,18 @@ import logging
 import os
 import re
 import shutil
+import struct
 import subprocess
 import tempfile
+import time
 
 from io import BytesIO
 
 from PIL import Image as PILImage, ImageOps
 
+import epoc
+import report
+
 
 TOOLS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIRECTORY = os.path.dirname(TOOLS_DIRECTORY)
@@ -39,10 +44,18 @@ OPOLUA_DIRECTORY = os.path.join(ROOT_DIRECTORY, "dependencies", "opolua")
 DUMPAIF_PATH = os.path.join(OPOLUA_DIRECTORY, "src", "dumpaif.lua")
 DUMPSIS_PATH = os.path.join(OPOLUA_DIRECTORY, "src", "dumpsis.lua")
 RECOGNIZE_PATH = os.path.join(OPOLUA_DIRECTORY, "src", "recognize.lua")
+RECOGNIZE_BATCH_PATH = os.path.join(TOOLS_DIRECTORY, "recognize_batch.lua")
+
+# Terminates the output for each file from `recognize_batch.lua`.
+RECORD_SEPARATOR = b"\x1e\n"
 
 UNSUPPORTED_MESSAGE = "Only ER5 SIS files are supported"
 NOT_AN_AI_MESSAGE = "Not an AIF file"
 
+# Converts 2bpp mask values into alpha, matching the masks produced from `dumpaif.lua` output: only black mask pixels
+# are opaque.
+MASK_ALPHA = [255 - min(255, i * 85) for i in range(256)]
+
 try:
     LUA_PATH = os.environ["LUA_PATH"]
 except KeyError:
@@ -58,6 +71,97 @@ class InvalidAIF(Exception):
     pass
 
 
+class CommandFailed(Exception):
+    pass
+
+
+class CommandTimeout(CommandFailed):
+    pass
+
+
+class Limits(object):
+    """
+    Limits applied to each opolua invocation: wall-clock timeout (seconds), CPU time (seconds), and address space
+    (bytes). `None` disables the corresponding limit.
+    """
+
+    __slots__ = ('timeout', 'cpu', 'memory')
+
+    def __init__(self, timeout=120, cpu=120, memory=2 * 1024 * 1024 * 1024):
+        self.timeout = timeout
+        self.cpu = cpu
+        self.memory = memory
+
+    def command(self, arguments):
+        """
+        Wrap `arguments` in a shell that sets the limits before exec'ing the command. Limits are applied this way,
+        rather than with `preexec_fn`, as opolua is run while other threads (e.g., background syncs) are active, where
+        `preexec_fn` is unsafe. Not all platforms enforce (or allow us to set) every limit, so failures are ignored.
+        """
+        limits = []
+        if self.cpu is not None:
+            limits.append(f"ulimit -t {int(self.cpu)} 2>/dev/null")
+        if self.memory is not None:
+            limits.append(f"ulimit -v {int(self.memory) // 1024} 2>/dev/null")
+        if not limits:
+            return arguments
+        return ["/bin/sh", "-c", "; ".join(limits + ['exec "$0" "$@"'])] + arguments
+
+    def scaled(self, count):
+        """
+        Limits for a single invocation that does the work of `count` invocations; the memory limit is unchanged.
+        """
+        return Limits(timeout=self.timeout * count if self.timeout is not None else None,
+                      cpu=self.cpu * count if self.cpu is not None else None,
+                      memory=self.memory)
+
+
+# Default limits for all invocations; the indexer replaces these based on its command line options.
+LIMITS = Limits()
+
+_version = None
+
+
+def version():
+    """
+    Identifier for the current version of opolua, derived from the contents of its Lua sources; used to determine
+    whether previously failing files are worth retrying.
+    """
+    global _version
+    if _version is None:
+        sha256 = hashlib.sha256()
+        source_directory = os.path.join(OPOLUA_DIRECTORY, "src")
+        for root, _, files in sorted(os.walk(source_directory)):
+            for name in sorted(files):
+                path = os.path.join(root, name)
+                sha256.update(os.path.relpath(path, source_directory).encode("utf-8"))
+                with open(path, "rb") as fh:
+                    sha256.update(fh.read())
+        _version = sha256.hexdigest()
+    return _version
+
+
+def run(arguments, limits=None):
+    limits = limits if limits is not None else LIMITS
+    start_time = time.monotonic()
+    try:
+        result = subprocess.run(limits.command([LUA_PATH] + arguments),
+                                capture_output=True,
+                                timeout=limits.timeout)
+        result.args = [LUA_PATH] + arguments
+        return result
+    except subprocess.TimeoutExpired:
+        raise CommandTimeout(f"'{' '.join(arguments)}' timed out after {limits.timeout} seconds")
+    finally:
+        report.RUN.subprocess(time.monotonic() - start_time)
+
+
+def check_returncode(result, stdout, stderr):
+    if result.returncode != 0:
+        raise CommandFailed(f"'{' '.join(result.args[1:])}' failed with exit code {result.returncode}\n"
+                            f"stdout:\n{stdout}\nstderr:\n{stderr}")
+
+
 class Image(object):
 
     def __init__(self, width, height, bpp, source):
@@ -89,8 +193,8 @@ class Image(object):
         self._source.save(os.path.join(directory_path, self.filename), format="GIF")
 
 
-def run_json_command(command, path):
-    result = subprocess.run([LUA_PATH, command, "--json", path], capture_output=True)
+def run_json_command(command, path, limits=None):
+    result = run([command, "--json", path], limits=limits)
     stdout = result.stdout.decode('utf-8')
     stderr = result.stderr.decode('utf-8')
 
@@ -99,30 +203,20 @@ def run_json_command(command, path):
     elif NOT_AN_AI_MESSAGE in stdout + stderr:
         raise InvalidAIF(stdout + stderr)
 
-    # Check the return code.
-    # It might be nicer to mark
-    try:
-        result.check_returncode()
-    except:
-        print("stderr")
-        print(stderr)
-        print("stdout")
-        print(stdout)
-        exit("Failed to read SIS file")
-
+    check_returncode(result, stdout, stderr)
     return json.loads(stdout)
 
 
-def dumpsis(path):
-    return run_json_command(DUMPSIS_PATH, path)
+def dumpsis(path, limits=None):
+    return run_json_command(DUMPSIS_PATH, path, limits=limits)
 
 
-def dumpaif(path):
-    return run_json_command(DUMPAIF_PATH, path)
+def dumpaif(path, limits=None):
+    return run_json_command(DUMPAIF_PATH, path, limits=limits)
 
 
-def dumpsis_extract(source, destination):
-    result = subprocess.run([LUA_PATH, DUMPSIS_PATH, source, destination], capture_output=True)
+def dumpsis_extract(source, destination, limits=None):
+    result = run([DUMPSIS_PATH, source, destination], limits=limits)
 
     # Sadly we ignore foreign characters right now and using CP1252 by default.
     stdout = result.stdout.decode('utf-8')
@@ -131,25 +225,133 @@ def dumpsis_extract(source, destination):
     if "Illegal byte sequence" in stdout + stderr:
         return None
 
-    # Check the return code.
-    # It might be nicer to mark
+    check_returncode(result, stdout, stderr)
+
+
+class Installer(object):
+    """
+    Installer analysed in a single pass: `dumpsis.lua` metadata, the embedded files (read in memory), and the decoded
+    icons from the first embedded AIF.
+    """
+
+    __slots__ = ('info', 'files', 'icons')
+
+    def __init__(self, info, files, icons):
+        self.info = info
+        self.files = files
+        self.icons = icons
+
+    def extract(self, destination):
+        for file in self.files:
+            path = os.path.join(destination, file.path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as fh:
+                fh.write(file.data)
+
+    def recognize(self, limits=None):
+        """
+        Recognize the embedded files that might be Psion files (see `epoc.classify`), returning the details for each.
+
+        `recognize.lua` only reads from paths, so the candidates are written to a temporary directory, but they're
+        recognized with a single Lua process (see `recognize_all`). Files the classifier rejects cost nothing.
+        """
+        candidates = [file for file in self.files
+                      if epoc.classify(bytes(file.data[:epoc.CLASSIFIER_HEADER_LENGTH])) is not None]
+        if not candidates:
+            return []
+        with tempfile.TemporaryDirectory() as directory_path:
+            paths = []
+            for index, file in enumerate(candidates):
+                path = os.path.join(directory_path, str(index), os.path.basename(file.path))
+                os.makedirs(os.path.dirname(path))
+                with open(path, "wb") as fh:
+                    fh.write(file.data)
+                paths.append(path)
+            return recognize_all(paths, limits=limits)
+
+
+def analyze_installer(path, limits=None):
+    """
+    Analyse the installer at `path`, reading the contents and icons in memory where possible.
+
+    The remaining process launches and temporary writes are:
+    - `dumpsis.lua` is always launched once for the metadata.
+    - Installers `epoc.read_sis_files` doesn't support are extracted to a temporary directory with `dumpsis.lua`.
+    - Icons `decode_icons` can't decode are written to a temporary file and extracted with `dumpaif.lua`.
+    - `Installer.recognize` writes candidate files to a temporary directory and launches Lua once to recognize them.
+    """
+    info = dumpsis(path, limits=limits)
+    with open(path, "rb") as fh:
+        data = fh.read()
     try:
-        result.check_returncode()
-    except:
-        print("stderr")
-        print(stderr)
-        print("stdout")
-        print(stdout)
-        exit("Failed to read SIS file")
+        files = epoc.read_sis_files(data)
+    except (epoc.UnsupportedFormat, struct.error, UnicodeDecodeError) as e:
+        logging.debug("Unable to read '%s' in memory (%s); extracting...", path, e)
+        files = extract_installer_files(path, limits=limits)
+
+    icons = []
+    aif_files = [file for file in files if file.path.lower().endswith(".aif")]
+    if aif_files:
+        icons = get_icons_data(bytes(aif_files[0].data), os.path.basename(aif_files[0].path), limits=limits)
+    return Installer(info, files, icons)
+
+
+def extract_installer_files(path, limits=None):
+    path = os.path.abspath(path)
+    files = []
+    with tempfile.TemporaryDirectory() as directory_path:
+        dumpsis_extract(path, directory_path, limits=limits)
+        for root, _, names in os.walk(directory_path):
+            for name in sorted(names):
+                file_path = os.path.join(root, name)
+                with open(file_path, "rb") as fh:
+                    files.append(epoc.SisFile(os.path.relpath(file_path, directory_path).replace("/", "\\"),
+                                              None,
+                                              fh.read()))
+    return files
+
+
+def get_icons_data(data, name, limits=None):
+    try:
+        return decode_icons(data)
+    except (epoc.UnsupportedFormat, struct.error, IndexError) as e:
+        logging.debug("Unable to decode icons in '%s' (%s); falling back to dumpaif...", name, e)
+        with tempfile.TemporaryDirectory() as directory_path:
+            aif_path = os.path.join(directory_path, name)
+            with open(aif_path, "wb") as fh:
+                fh.write(data)
+            return extract_icons(aif_path, limits=limits)
+
+
+def get_icons(aif_path, limits=None):
+    with open(aif_path, "rb") as fh:
+        data = fh.read()
+    try:
+        return decode_icons(data)
+    except (epoc.UnsupportedFormat, struct.error, IndexError) as e:
+        logging.debug("Unable to decode icons in '%s' (%s); falling back to dumpaif...", aif_path, e)
+        return extract_icons(aif_path, limits=limits)
+
+
+def decode_icons(data):
+    icons = []
+    for bitmap, mask in epoc.read_aif_icons(data):
+        image = bitmap.image().convert("RGBA")
+        # `dumpaif.lua` output was only ever matched against 2bpp masks of the same size as the icon.
+        if mask.bpp == 2 and (mask.width, mask.height) == (bitmap.width, bitmap.height):
+            image.putalpha(mask.image().convert("L").point(MASK_ALPHA))
+        icons.append(Image(bitmap.width, bitmap.height, bitmap.bpp, image))
+    return icons
 
 
-def get_icons(aif_path):
+def extract_icons(aif_path, limits=None):
     aif_path = os.path.abspath(aif_path)
     with tempfile.TemporaryDirectory() as directory_path:
         aif_basename = os.path.basename(aif_path)
         temporary_aif_path = os.path.join(directory_path, aif_basename)
         shutil.copyfile(aif_path, temporary_aif_path)
-        subprocess.check_output([LUA_PATH, DUMPAIF_PATH, "-e", temporary_aif_path])
+        result = run([DUMPAIF_PATH, "-e", temporary_aif_path], limits=limits)
+        check_returncode(result, result.stdout.decode('utf-8'), result.stderr.decode('utf-8'))
         aif_basename = os.path.basename(temporary_aif_path)
         aif_dirname = os.path.dirname(temporary_aif_path)
         icon_candidates = os.listdir(aif_dirname)
@@ -180,9 +382,45 @@ def get_icons(aif_path):
         return icons
 
 
-def recognize(path):
+def recognize(path, limits=None):
     logging.debug("Recognizing '%s'...", path)
     try:
-        return run_json_command(RECOGNIZE_PATH, path)
+        return run_json_command(RECOGNIZE_PATH, path, limits=limits)
     except:
         return {"type": "unknown"}
+
+
+def recognize_files(paths, limits=None):
+    """
+    Recognize all of `paths` with a single invocation of `recognize_batch.lua`, returning the details for each, in
+    order. As with `recognize`, files `recognize.lua` fails on are unknown. Raises `CommandFailed` if the batch fails.
+    """
+    logging.debug("Recognizing %d files...", len(paths))
+    result = run([RECOGNIZE_BATCH_PATH, RECOGNIZE_PATH] + paths, limits=limits)
+    check_returncode(result,
+                     result.stdout.decode('utf-8', errors='replace'),
+                     result.stderr.decode('utf-8', errors='replace'))
+    records = result.stdout.split(RECORD_SEPARATOR)
+    if len(records) != len(paths) + 1 or records[-1]:
+        raise CommandFailed(f"'{RECOGNIZE_BATCH_PATH}' returned {len(records) - 1} results for {len(paths)} files")
+    details = []
+    for record in records[:-1]:
+        try:
+            details.append(json.loads(record))
+        except ValueError:
+            details.append({"type": "unknown"})
+    return details
+
+
+def recognize_all(paths, limits=None):
+    """
+    Recognize all of `paths` with a single Lua process, falling back to one process per file if that fails.
+    """
+    if not paths:
+        return []
+    limits = limits if limits is not None else LIMITS
+    try:
+        return recognize_files(paths, limits=limits.scaled(len(paths)))
+    except CommandFailed as e:
+        logging.warning("Unable to recognize files in a single pass (%s); recognizing individually...", e)
+        return [recognize(path, limits=limits) for path in paths]
@@ -0,0 +1,272 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import re
+
+import msgpack
+
+import stream
+
+
+# Compact MessagePack encoding of the API, published alongside the JSON (see site/api/index.md for the schema).
+# Programs are encoded as positional arrays rather than maps, repeated strings are replaced by indexes into a string
+# table shared by the whole file, and SHA-256s and UIDs are stored as raw bytes.
+
+VERSION = 1
+EXTENSION = ".msgpack"
+CONTENT_TYPE = "application/vnd.msgpack"
+
+UID_PATTERN = re.compile(r"^0x[0-9a-f]{8}$")
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+# Icons and readmes are content-addressed, so their paths are stored as the raw hash where possible.
+ICONS_DIRECTORY = "icons"
+ICON_EXTENSION = ".gif"
+READMES_DIRECTORY = "readmes"
+README_EXTENSION = ".txt"
+
+
+class DecodeError(Exception):
+    pass
+
+
+class StringTable(object):
+    """
+    Strings shared by a file. The first occurrence of each string is stored in place, and appended to the table; later
+    occurrences are stored as the (integer) index of the string in the table. Tables are therefore built in the same
+    order when encoding and decoding, and strings stay close to where they are first used, which helps when the file
+    is compressed for transfer.
+    """
+
+    def __init__(self):
+        self.strings = []
+        self.indexes = {}
+
+    def encode(self, value):
+        if value is None:
+            return None
+        index = self.indexes.get(value)
+        if index is not None:
+            return index
+        self.indexes[value] = len(self.strings)
+        self.strings.append(value)
+        return value
+
+    def decode(self, value):
+        if value is None:
+            return None
+        if isinstance(value, str):
+            self.strings.append(value)
+            return value
+        return self.strings[value]
+
+
+def encode_identifier(identifier, strings):
+    # UIDs are stored as 4 bytes and SHA-256s (used as identifiers for apps without a UID) as 32 bytes; anything else
+    # is stored as a string.
+    if UID_PATTERN.match(identifier) or SHA256_PATTERN.match(identifier):
+        return bytes.fromhex(identifier[2:] if identifier.startswith("0x") else identifier)
+    return strings.encode(identifier)
+
+
+def decode_identifier(value, strings):
+    if isinstance(value, bytes):
+        return "0x" + value.hex() if len(value) == 4 else value.hex()
+    return strings.decode(value)
+
+
+def encode_path(path, directory, extension, strings):
+    name, ext = os.path.splitext(path)
+    if os.path.dirname(name) == directory and ext == extension and SHA256_PATTERN.match(os.path.basename(name)):
+        return bytes.fromhex(os.path.basename(name))
+    return strings.encode(path)
+
+
+def decode_path(value, directory, extension, strings):
+    if isinstance(value, bytes):
+        return directory + "/" + value.hex() + extension
+    return strings.decode(value)
+
+
+# Encoding and decoding are written field by field, in array order, as the string tables depend on the order in which
+# strings are visited.
+
+def encode_icon(icon, strings):
+    if icon is None:
+        return None
+    path = encode_path(icon['path'], ICONS_DIRECTORY, ICON_EXTENSION, strings)
+    atlas = icon.get('atlas')
+    if atlas is not None:
+        atlas = [strings.encode(atlas['path']), atlas['x'], atlas['y']]
+    return [path, icon['width'], icon['height'], atlas]
+
+
+def decode_icon(value, strings):
+    path, width, height, atlas = value
+    icon = {
+        'path': decode_path(path, ICONS_DIRECTORY, ICON_EXTENSION, strings),
+        'width': width,
+        'height': height,
+    }
+    if atlas is not None:
+        icon['atlas'] = {
+            'path': strings.decode(atlas[0]),
+            'x': atlas[1],
+            'y': atlas[2],
+        }
+    return icon
+
+
+def encode_release(release, strings):
+    reference = [[strings.encode(item['name']), strings.encode(item['url'])] for item in release['reference']]
+    kind = strings.encode(release['kind'])
+    sha256 = bytes.fromhex(release['sha256'])
+    uid = encode_identifier(release['uid'], strings)
+    name = strings.encode(release['name'])
+    version = strings.encode(release['version'])
+    tags = [strings.encode(tag) for tag in release['tags']]
+    icon = encode_icon(release.get('icon'), strings)
+    return [reference, kind, sha256, uid, name, version, tags, icon]
+
+
+def decode_release(value, strings):
+    reference, kind, sha256, uid, name, version, tags, icon = value
+    release = {
+        'reference': [{'name': strings.decode(name), 'url': strings.decode(url)} for name, url in reference],
+        'kind': strings.decode(kind),
+        'sha256': sha256.hex(),
+        'uid': decode_identifier(uid, strings),
+        'name': strings.decode(name),
+        'version': strings.decode(version),
+        'tags': [strings.decode(tag) for tag in tags],
+    }
+    icon = decode_icon(icon, strings) if icon is not None else None
+    if icon is not None:
+        release['icon'] = icon
+    return release
+
+
+def encode_program(program, strings):
+    uid = encode_identifier(program['uid'], strings)
+    name = strings.encode(program['name'])
+    summary = strings.encode(program['summary'])
+    tags = [strings.encode(tag) for tag in program['tags']]
+    kinds = [strings.encode(kind) for kind in program['kinds']]
+    icon = encode_icon(program.get('icon'), strings)
+    readme = program.get('readme')
+    if readme is not None:
+        readme = [encode_path(readme['path'], READMES_DIRECTORY, README_EXTENSION, strings),
+                  bytes.fromhex(readme['sha256']),
+                  readme['size'],
+                  strings.encode(readme['excerpt'])]
+    screenshots = program.get('screenshots')
+    if screenshots is not None:
+        screenshots = [[strings.encode(screenshot['path']), screenshot['width'], screenshot['height']]
+                       for screenshot in screenshots]
+    versions = [[strings.encode(version['version']),
+                 [[bytes.fromhex(variant['identifier']),
+                   [encode_release(release, strings) for release in variant['items']]]
+                  for variant in version['variants']]]
+                for version in program['versions']]
+    return [uid, name, summary, tags, kinds, icon, readme, screenshots, versions]
+
+
+def decode_program(value, strings):
+    uid, name, summary, tags, kinds, icon, readme, screenshots, versions = value
+    uid = decode_identifier(uid, strings)
+    name = strings.decode(name)
+    summary = strings.decode(summary)
+    tags = [strings.decode(tag) for tag in tags]
+    kinds = [strings.decode(kind) for kind in kinds]
+    icon = decode_icon(icon, strings) if icon is not None else None
+    if readme is not None:
+        readme = {
+            'path': decode_path(readme[0], READMES_DIRECTORY, README_EXTENSION, strings),
+            'sha256': readme[1].hex(),
+            'size': readme[2],
+            'excerpt': strings.decode(readme[3]),
+        }
+    if screenshots is not None:
+        screenshots = [{'path': strings.decode(path), 'width': width, 'height': height}
+                       for path, width, height in screenshots]
+    versions = [{'version': strings.decode(version),
+                 'variants': [{'identifier': identifier.hex(),
+                               'items': [decode_release(release, strings) for release in releases]}
+                              for identifier, releases in variants]}
+                for version, variants in versions]
+
+    # Keys are added in the same order as the JSON.
+    program = {
+        'uid': uid,
+        'name': name,
+        'summary': summary,
+        'versions': versions,
+        'tags': tags,
+        'kinds': kinds,
+    }
+    if readme is not None:
+        program['readme'] = readme
+    if icon is not None:
+        program['icon'] = icon
+    if screenshots is not None:
+        program['screenshots'] = screenshots
+    return program
+
+
+def write_programs(programs_path, count, path):
+    """
+    Encode the `count` programs in `programs_path` (as written by `stream.write_array`, which returns the count) to
+    `path`, streaming them from the JSON one at a time.
+    """
+    strings = StringTable()
+    packer = msgpack.Packer()
+    with open(path, "wb") as fh:
+        fh.write(packer.pack_array_header(2))
+        fh.write(packer.pack(VERSION))
+        fh.write(packer.pack_array_header(count))
+        written = 0
+        for program in stream.read_array(programs_path):
+            fh.write(packer.pack(encode_program(program, strings)))
+            written += 1
+    if written != count:
+        raise ValueError(f"Expected {count} programs in '{programs_path}' but found {written}.")
+
+
+def read_programs(path):
+    with open(path, "rb") as fh:
+        version, programs = msgpack.unpackb(fh.read())
+    if version != VERSION:
+        raise DecodeError(f"Unsupported version {version}.")
+    strings = StringTable()
+    return [decode_program(program, strings) for program in programs]
+
+
+def write_sources(sources, path):
+    with open(path, "wb") as fh:
+        fh.write(msgpack.packb([VERSION, [[source['path'], source['name'], source['description'], source['url'],
+                                  source['html_url']]
+                                 for source in sources]]))
+
+
+def write_summary(summary, path):
+    with open(path, "wb") as fh:
+        fh.write(msgpack.packb([VERSION, [summary['installerCount'], summary['uidCount'], summary['versionCount'],
+                                 summary['shaCount']]]))
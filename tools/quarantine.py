@@ -0,0 +1,80 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import datetime
+import json
+import logging
+import os
+
+
+# Failure messages can include the full output of the failing command; we only keep the start.
+MAXIMUM_REASON_LENGTH = 2000
+
+
+class Quarantine(object):
+    """
+    Persistent record of files that caused opolua to fail or time out, keyed by SHA-256. Quarantined files are skipped
+    on subsequent runs until the opolua version changes, at which point they're retried.
+    """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+        try:
+            with open(path) as fh:
+                self.items = json.load(fh)
+        except FileNotFoundError:
+            self.items = {}
+        self.added = []
+
+    def contains(self, sha256):
+        item = self.items.get(sha256)
+        return item is not None and item['opolua_version'] == self.version
+
+    def add(self, sha256, path, reason):
+        self.items[sha256] = {
+            'path': path,
+            'reason': reason[:MAXIMUM_REASON_LENGTH],
+            'opolua_version': self.version,
+            'timestamp': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        self.added.append(sha256)
+        self.save()
+
+    def discard(self, sha256):
+        if sha256 not in self.items:
+            return
+        logging.info("Removing '%s' from quarantine...", self.items[sha256]['path'])
+        del self.items[sha256]
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as fh:
+            json.dump(self.items, fh, indent=4)
+        os.replace(temporary_path, self.path)
+
+    def report(self):
+        logging.info("%d files quarantined (%d this run).", len(self.items), len(self.added))
+        for sha256, item in sorted(self.items.items(), key=lambda x: x[1]['path']):
+            status = "" if item['opolua_version'] == self.version else " (will be retried)"
+            logging.info("%s %s%s", sha256, item['path'], status)
+            logging.info("    %s", item['reason'].splitlines()[0] if item['reason'] else "")
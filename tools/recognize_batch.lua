@@ -0,0 +1,101 @@
+-- Copyright (c) 2024 Jason Morley
+--
+-- Permission is hereby granted, free of charge, to any person obtaining a copy
+-- of this software and associated documentation files (the "Software"), to deal
+-- in the Software without restriction, including without limitation the rights
+-- to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+-- copies of the Software, and to permit persons to whom the Software is
+-- furnished to do so, subject to the following conditions:
+--
+-- The above copyright notice and this permission notice shall be included in all
+-- copies or substantial portions of the Software.
+--
+-- THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+-- IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+-- FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+-- AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+-- LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+-- OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+-- SOFTWARE.
+
+-- Runs `recognize.lua --json` over several files in a single Lua process (see `opolua.recognize_files`).
+--
+-- Usage: lua recognize_batch.lua <recognize.lua> <path>...
+--
+-- The output for each path is followed by an ASCII record separator and a newline. Output from a run that fails (raises
+-- an error or exits with a failure status) is discarded, leaving an empty record.
+
+local RECORD_SEPARATOR = "\30\n"
+
+local recognize_path = arg[1]
+local recognize = assert(loadfile(recognize_path))
+
+local paths = {}
+for i = 2, #arg do
+    paths[#paths + 1] = arg[i]
+end
+
+local stdout, write, output, print, exit = io.stdout, io.write, io.output, print, os.exit
+
+local Exit = {}
+
+for _, path in ipairs(paths) do
+    local buffer = {}
+
+    local function capture(...)
+        for i = 1, select("#", ...) do
+            buffer[#buffer + 1] = tostring((select(i, ...)))
+        end
+    end
+
+    local captured_stdout = {}
+    function captured_stdout:write(...)
+        capture(...)
+        return self
+    end
+    function captured_stdout:flush()
+        return self
+    end
+    function captured_stdout:setvbuf()
+        return true
+    end
+    function captured_stdout:close()
+        return true
+    end
+
+    io.stdout = captured_stdout
+    io.write = function(...)
+        capture(...)
+        return captured_stdout
+    end
+    io.output = function()
+        return captured_stdout
+    end
+    _G.print = function(...)
+        for i = 1, select("#", ...) do
+            if i > 1 then
+                capture("\t")
+            end
+            capture((select(i, ...)))
+        end
+        capture("\n")
+    end
+    os.exit = function(code)
+        error(setmetatable({ success = code == nil or code == true or code == 0 }, Exit), 0)
+    end
+
+    _G.arg = { [0] = recognize_path, "--json", path }
+    local ok, err = pcall(recognize, "--json", path)
+    if not ok and getmetatable(err) == Exit then
+        ok = err.success
+    end
+
+    io.stdout, io.write, io.output, _G.print, os.exit = stdout, write, output, print, exit
+
+    if ok then
+        stdout:write(table.concat(buffer))
+    else
+        io.stderr:write(path, ": ", tostring(err), "\n")
+    end
+    stdout:write(RECORD_SEPARATOR)
+end
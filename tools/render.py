@@ -0,0 +1,172 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import jinja2
+import yaml
+
+import report
+
+
+# Program pages are rendered ahead of the Jekyll build from a Jinja template, in parallel, and only when their data or
+# the templates have changed, leaving Jekyll to build just the hand-written pages. The template shares the Jekyll
+# includes, which are written in the syntax common to Liquid and Jinja, and is given the same `site` and `page`
+# variables, and `absolute_url` filter, as the Jekyll layouts. Undefined values chain, as `nil` does in Liquid, so the
+# includes can test attributes of missing values (e.g., `include.icon.atlas` for a release without an icon).
+
+TEMPLATES_DIRECTORY = "_templates"
+INCLUDES_DIRECTORY = "_includes"
+PROGRAM_TEMPLATE = "program.html"
+CHUNK_SIZE = 32
+
+_template = None
+_site = None
+
+
+def templates_hash(site_directory):
+    sha256 = hashlib.sha256()
+    paths = [os.path.join(site_directory, "_config.yml")]
+    for directory in [TEMPLATES_DIRECTORY, INCLUDES_DIRECTORY]:
+        directory_path = os.path.join(site_directory, directory)
+        paths.extend([os.path.join(directory_path, name) for name in sorted(os.listdir(directory_path))])
+    for path in paths:
+        sha256.update(os.path.basename(path).encode("utf-8"))
+        with open(path, "rb") as fh:
+            sha256.update(fh.read())
+    return sha256.hexdigest()
+
+
+def page_hash(program, templates):
+    sha256 = hashlib.sha256(templates.encode("utf-8"))
+    sha256.update(json.dumps(program, sort_keys=True).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+def absolute_url(site, path):
+    # Matches Jekyll's `absolute_url` filter for the paths used by the includes.
+    return (site.get('url') or "") + (site.get('baseurl') or "") + "/" + path.lstrip("/")
+
+
+def _initialize(site_directory):
+    global _template, _site
+    with open(os.path.join(site_directory, "_config.yml")) as fh:
+        _site = yaml.safe_load(fh)
+    environment = jinja2.Environment(loader=jinja2.FileSystemLoader([os.path.join(site_directory, TEMPLATES_DIRECTORY),
+                                                                     os.path.join(site_directory, INCLUDES_DIRECTORY)]),
+                                     autoescape=True,
+                                     undefined=jinja2.ChainableUndefined)
+    environment.filters['absolute_url'] = lambda path: absolute_url(_site, path)
+    _template = environment.get_template(PROGRAM_TEMPLATE)
+
+
+def _render_pages(jobs):
+    for job in jobs:
+        _render_page(*job)
+
+
+def _render_page(path, program):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    page = {
+        'title': program['name'],
+        'url': f"/programs/{program['uid']}/",
+        'program': program,
+    }
+    temporary_path = path + ".tmp"
+    with open(temporary_path, "w", encoding="utf-8") as fh:
+        fh.write(_template.render(site=_site, page=page, program=program))
+    os.replace(temporary_path, path)
+
+
+def render(programs, site_directory, state_path, processes=None):
+    """
+    Render a page for each program to `site_directory`/programs/<uid>/index.html, skipping pages whose program data and
+    templates are unchanged since the last render (as recorded in `state_path`), and removing pages for programs that
+    no longer exist.
+
+    `programs` is iterated once, and pages are rendered in chunks as it's read, with a bounded number of chunks in
+    flight, so only the chunks being rendered (and a hash per program) are held in memory.
+    """
+    programs_path = os.path.join(site_directory, "programs")
+    try:
+        with open(state_path) as fh:
+            previous = json.load(fh)
+    except (OSError, ValueError):
+        previous = {}
+
+    templates = templates_hash(site_directory)
+    workers = processes or os.cpu_count() or 1
+    hashes = {}
+    chunk = []
+    pending = set()
+    rendered = 0
+    executor = None
+
+    def wait(return_when):
+        done, _ = concurrent.futures.wait(pending, return_when=return_when)
+        for future in done:
+            future.result()
+        pending.difference_update(done)
+
+    def submit():
+        nonlocal executor, rendered
+        if executor is None:
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                              initializer=_initialize,
+                                                              initargs=(site_directory,))
+        while len(pending) >= workers * 2:
+            wait(concurrent.futures.FIRST_COMPLETED)
+        pending.add(executor.submit(_render_pages, list(chunk)))
+        rendered += len(chunk)
+        chunk.clear()
+
+    try:
+        for program in programs:
+            uid = program['uid']
+            path = os.path.join(programs_path, uid, "index.html")
+            hashes[uid] = page_hash(program, templates)
+            unchanged = previous.get(uid) == hashes[uid] and os.path.exists(path)
+            report.RUN.cache("pages", unchanged)
+            if not unchanged:
+                chunk.append((path, program))
+                if len(chunk) >= CHUNK_SIZE:
+                    submit()
+        if chunk:
+            submit()
+        wait(concurrent.futures.ALL_COMPLETED)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+    logging.info("Rendered %d of %d program pages.", rendered, len(hashes))
+
+    for uid in set(previous.keys()) - set(hashes.keys()):
+        logging.info("Removing page for '%s'...", uid)
+        shutil.rmtree(os.path.join(programs_path, uid), ignore_errors=True)
+
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    temporary_path = state_path + ".tmp"
+    with open(temporary_path, "w") as fh:
+        json.dump(hashes, fh)
+    os.replace(temporary_path, state_path)
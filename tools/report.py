@@ -0,0 +1,228 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import collections
+import contextlib
+import datetime
+import json
+import logging
+import os
+import resource
+import statistics
+import sys
+import time
+
+
+# Regressions are flagged against the median of the most recent runs; stages shorter than the minimum duration are too
+# noisy to compare.
+BASELINE_RUNS = 5
+THRESHOLD = 0.25
+MINIMUM_DURATION = 1.0
+
+# Metrics compared against the baseline, and whether larger values are better.
+COMPARED_METRICS = [
+    ('wallTime', False),
+    ('subprocessTime', False),
+    ('assetsPerSecond', True),
+    ('peakRSS', False),
+]
+
+
+def peak_rss(who=resource.RUSAGE_SELF):
+    # ru_maxrss is reported in bytes on macOS and kilobytes elsewhere.
+    maxrss = resource.getrusage(who).ru_maxrss
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+class Stage(object):
+
+    __slots__ = ('name', 'wall_time', 'assets', 'bytes_extracted', 'subprocess_count', 'subprocess_time',
+                 'cache_hits', 'cache_misses', 'peak_rss')
+
+    def __init__(self, name):
+        self.name = name
+        self.wall_time = 0.0
+        self.assets = 0
+        self.bytes_extracted = 0
+        self.subprocess_count = 0
+        self.subprocess_time = 0.0
+        self.cache_hits = collections.Counter()
+        self.cache_misses = collections.Counter()
+        self.peak_rss = 0
+
+    def as_dict(self):
+        caches = sorted(set(self.cache_hits.keys()) | set(self.cache_misses.keys()))
+        return {
+            'wallTime': self.wall_time,
+            'assets': self.assets,
+            'assetsPerSecond': self.assets / self.wall_time if self.wall_time else 0.0,
+            'bytesExtracted': self.bytes_extracted,
+            'subprocessCount': self.subprocess_count,
+            'subprocessTime': self.subprocess_time,
+            'cacheHitRates': {cache: self.cache_hits[cache] / (self.cache_hits[cache] + self.cache_misses[cache])
+                              for cache in caches},
+            'peakRSS': self.peak_rss,
+        }
+
+
+class Run(object):
+    """
+    Performance metrics for a single indexer run, broken down by stage (e.g., the import of each source). Counters are
+    attributed to the active stage, if any, and to the run as a whole.
+    """
+
+    def __init__(self):
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+        self.start_time = time.monotonic()
+        self.total = Stage("total")
+        self.stages = {}
+        self.active = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        stage = self.stages.setdefault(name, Stage(name))
+        previous = self.active
+        self.active = stage
+        start_time = time.monotonic()
+        try:
+            yield stage
+        finally:
+            stage.wall_time += time.monotonic() - start_time
+            stage.peak_rss = peak_rss()
+            self.active = previous
+
+    def _targets(self):
+        return [self.total] if self.active is None else [self.total, self.active]
+
+    def asset(self):
+        for stage in self._targets():
+            stage.assets += 1
+
+    def extracted(self, size):
+        for stage in self._targets():
+            stage.bytes_extracted += size
+
+    def subprocess(self, duration):
+        for stage in self._targets():
+            stage.subprocess_count += 1
+            stage.subprocess_time += duration
+
+    def cache(self, name, hit):
+        for stage in self._targets():
+            if hit:
+                stage.cache_hits[name] += 1
+            else:
+                stage.cache_misses[name] += 1
+
+    def as_dict(self, commands):
+        self.total.wall_time = time.monotonic() - self.start_time
+        self.total.peak_rss = peak_rss()
+        return {
+            'started': self.started.isoformat(),
+            'commands': commands,
+            'total': self.total.as_dict(),
+            'peakChildRSS': peak_rss(resource.RUSAGE_CHILDREN),
+            'stages': {name: stage.as_dict() for name, stage in self.stages.items()},
+        }
+
+    def save(self, path, commands):
+        """
+        Write the report for this run to `path`/report.json and append it to the history in `path`/reports.jsonl.
+        """
+        os.makedirs(path, exist_ok=True)
+        report = self.as_dict(commands)
+        logging.info("Writing performance report '%s'...", os.path.join(path, "report.json"))
+        with open(os.path.join(path, "report.json"), "w") as fh:
+            json.dump(report, fh, indent=2)
+        with open(os.path.join(path, "reports.jsonl"), "a") as fh:
+            fh.write(json.dumps(report) + "\n")
+
+
+# Metrics for the current process.
+RUN = Run()
+
+
+def load_history(path):
+    history = []
+    try:
+        with open(os.path.join(path, "reports.jsonl")) as fh:
+            for line in fh:
+                try:
+                    history.append(json.loads(line))
+                except ValueError:
+                    logging.warning("Ignoring malformed report in history.")
+    except FileNotFoundError:
+        pass
+    return history
+
+
+def summarize(report):
+    logging.info("Run started %s (%s).", report['started'], ", ".join(report['commands']))
+    for name, stage in [("total", report['total'])] + list(report['stages'].items()):
+        logging.info("%s: %.1fs, %d assets (%.1f/s), %d bytes extracted, %d subprocesses (%.1fs), peak RSS %d",
+                     name, stage['wallTime'], stage['assets'], stage['assetsPerSecond'], stage['bytesExtracted'],
+                     stage['subprocessCount'], stage['subprocessTime'], stage['peakRSS'])
+        for cache, rate in stage['cacheHitRates'].items():
+            logging.info("    %s cache hit rate %.0f%%", cache, rate * 100)
+
+
+def compare(report, baseline_reports, threshold=THRESHOLD):
+    """
+    Compare the stages of `report` against the median of the same stages in `baseline_reports`, returning a list of
+    `(stage, metric, value, baseline)` regressions beyond `threshold`.
+    """
+    regressions = []
+    for name, stage in [("total", report['total'])] + list(report['stages'].items()):
+        baselines = [baseline['total'] if name == "total" else baseline['stages'][name]
+                     for baseline in baseline_reports
+                     if name == "total" or name in baseline['stages']]
+        if not baselines or statistics.median([baseline['wallTime'] for baseline in baselines]) < MINIMUM_DURATION:
+            continue
+        for metric, larger_is_better in COMPARED_METRICS:
+            value = stage[metric]
+            baseline = statistics.median([baseline[metric] for baseline in baselines])
+            if baseline == 0:
+                continue
+            change = (value - baseline) / baseline
+            if (-change if larger_is_better else change) > threshold:
+                regressions.append((name, metric, value, baseline))
+    return regressions
+
+
+def report(path, compare_baseline=False, threshold=THRESHOLD):
+    history = load_history(path)
+    if not history:
+        exit(f"No performance reports found in '{path}'.")
+    latest = history[-1]
+    summarize(latest)
+    if not compare_baseline:
+        return
+
+    # Only runs of the same commands make a meaningful baseline.
+    baseline_reports = [item for item in history[:-1] if item['commands'] == latest['commands']][-BASELINE_RUNS:]
+    if not baseline_reports:
+        logging.info("No earlier runs of '%s' to compare against.", ", ".join(latest['commands']))
+        return
+    regressions = compare(latest, baseline_reports, threshold=threshold)
+    for name, metric, value, baseline in regressions:
+        logging.warning("%s: %s regressed to %.2f from a baseline of %.2f.", name, metric, value, baseline)
+    if regressions:
+        exit(f"{len(regressions)} regressions against the last {len(baseline_reports)} runs.")
+    logging.info("No regressions against the last %d runs.", len(baseline_reports))
@@ -0,0 +1,57 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+
+
+def write_array(path, items):
+    """
+    Write `items`, an iterable of JSON-serializable values, to `path` as a JSON array, one item at a time and one item
+    per line, so that arrays much larger than memory can be written and later read back with `read_array`.
+    """
+    temporary_path = path + ".tmp"
+    count = 0
+    with open(temporary_path, "w", encoding="utf-8") as fh:
+        fh.write("[")
+        for item in items:
+            fh.write(",\n" if count else "\n")
+            fh.write(json.dumps(item))
+            count += 1
+        fh.write("\n]\n")
+    os.replace(temporary_path, path)
+    return count
+
+
+def read_array(path):
+    """
+    Iterate over the items of a JSON array written by `write_array`, without loading the whole array. Arrays in any
+    other layout are loaded in full.
+    """
+    with open(path, encoding="utf-8") as fh:
+        if fh.readline() != "[\n":
+            fh.seek(0)
+            yield from json.load(fh)
+            return
+        for line in fh:
+            line = line.rstrip("\n")
+            if line == "]":
+                return
+            yield json.loads(line[:-1] if line.endswith(",") else line)
@@ -0,0 +1,111 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import tempfile
+import unittest
+
+import epoc
+
+
+def crc_ccitt(data):
+    # Bitwise CRC-CCITT (as used by Mem::Crc), kept independent of the table-driven implementation under test.
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) & 0xffff if crc & 0x8000 else (crc << 1) & 0xffff
+    return crc
+
+
+# The first `CLASSIFIER_HEADER_LENGTH` bytes of each kind of file, laid out as in real files: EPOC32 headers use the
+# UIDs from the EPOC32 SDK (e.g., KUidApp, KUidAppInfoFile, KUidSisFileEr5) with the checksums given by `crc_ccitt`,
+# and SIBO headers their file signatures.
+SIS_HEADER = bytes.fromhex("5f4a00106d00001019040010286cde75" "0100000003000000" "0000000000000000")
+APP_HEADER = bytes.fromhex("790000106c0000105f4a00101f050fb7" "45504f4302000000" "2800000000000000")
+AIF_HEADER = bytes.fromhex("370000106a0000105f4a001035c80fb7" "1400000000000000" "0000000000000000")
+CHECKED_HEADER = bytes.fromhex("123a0010604a00105f4a001097d6b618" "0000000000000000" "0000000000000000")
+OPO_HEADER = b"OPLObjectFile**\x00\x02\x00\x1b\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+OPA_HEADER = b"OPLObjectFile**\x00\x02\x00\x1b\x00\x0cSYS$PRGO\x00\x00\x00\x00\x00"
+IMG_HEADER = b"ImageFileType**\x00\x0f\x10\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+DBF_HEADER = b"OPLDatabaseFile\x00\x0f\x10\x16\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+PIC_HEADER = b"PIC\xdc\x30\x30\x01\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00"
+
+PNG_HEADER = b"\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR\x00\x00\x00\x18\x00\x00\x00\x18\x08\x06\x00\x00\x00"
+HTML_HEADER = b"<!DOCTYPE html>\n<html lang=\"en\">\n"
+TEXT_HEADER = b"This is the readme for the game."
+
+
+class TestUidChecksum(unittest.TestCase):
+
+    def test_matches_reference_implementation(self):
+        for header in [SIS_HEADER, APP_HEADER, AIF_HEADER, CHECKED_HEADER]:
+            uids = header[:12]
+            expected = (crc_ccitt(uids[1::2]) << 16) | crc_ccitt(uids[0::2])
+            self.assertEqual(epoc.uid_checksum(uids), expected)
+            self.assertEqual(epoc.uid_checksum(uids), int.from_bytes(header[12:16], "little"))
+
+
+class TestClassify(unittest.TestCase):
+
+    def test_epoc32(self):
+        for header in [SIS_HEADER, APP_HEADER, AIF_HEADER]:
+            self.assertEqual(epoc.classify(header), "epoc32")
+
+    def test_epoc32_checked_uid(self):
+        # Unknown UIDs are only accepted if the checksum is valid.
+        self.assertEqual(epoc.classify(CHECKED_HEADER), "epoc32")
+        corrupt = CHECKED_HEADER[:12] + bytes([CHECKED_HEADER[12] ^ 0xff]) + CHECKED_HEADER[13:]
+        self.assertIsNone(epoc.classify(corrupt))
+
+    def test_sibo(self):
+        for header in [OPO_HEADER, OPA_HEADER, IMG_HEADER, DBF_HEADER, PIC_HEADER]:
+            self.assertEqual(epoc.classify(header), "sibo")
+
+    def test_not_psion(self):
+        for header in [PNG_HEADER, HTML_HEADER, TEXT_HEADER, bytes(epoc.CLASSIFIER_HEADER_LENGTH)]:
+            self.assertIsNone(epoc.classify(header))
+
+    def test_short(self):
+        for header in [b"", b"OPL", b"hello, world", APP_HEADER[:12], b"\x89PNG\r\n\x1a\n"]:
+            self.assertIsNone(epoc.classify(header))
+
+
+class TestIsCandidate(unittest.TestCase):
+
+    def test_is_candidate(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for name, header, expected in [("GAME.SIS", SIS_HEADER, True),
+                                           ("GAME.APP", APP_HEADER, True),
+                                           ("GAME.OPO", OPO_HEADER, True),
+                                           ("GAME.IMG", IMG_HEADER, True),
+                                           ("ICON.PNG", PNG_HEADER, False),
+                                           ("INDEX.HTM", HTML_HEADER, False),
+                                           ("README.TXT", TEXT_HEADER, False),
+                                           ("EMPTY", b"", False),
+                                           ("SHORT", b"0123456789", False)]:
+                path = os.path.join(directory, name)
+                with open(path, "wb") as fh:
+                    fh.write(header)
+                self.assertEqual(epoc.is_candidate(path), expected, name)
+
+
+if __name__ == "__main__":
+    unittest.main()
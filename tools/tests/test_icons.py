@@ -0,0 +1,258 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import struct
+import tempfile
+import unittest
+
+import epoc
+import opolua
+
+
+# Fixtures are built with a deliberately naive encoder, independent of the decoder under test: pixels are packed least
+# significant bits first, with each scan line padded to a 32-bit boundary, and compressed by scanning for runs.
+
+GREY_VALUES = {1: [0, 255], 2: [0, 85, 170, 255], 4: [i * 17 for i in range(16)], 8: list(range(256))}
+COLOUR_VALUES = {0: (0x00, 0x00, 0x00), 5: (0xff, 0x00, 0x00), 9: (0x00, 0x00, 0xff), 15: (0xff, 0xff, 0xff)}
+
+
+def pattern(width, height, bpp):
+    levels = 1 << bpp
+    return [[(x * 3 + y * 5 + x * y) % levels for x in range(width)] for y in range(height)]
+
+
+def pack(rows, bpp):
+    data = bytearray()
+    for row in rows:
+        line = bytearray()
+        for index, pixel in enumerate(row):
+            if index * bpp % 8 == 0:
+                line.append(0)
+            line[-1] |= pixel << (index * bpp % 8)
+        data += line + bytes(-len(line) % 4)
+    return bytes(data)
+
+
+def encode_byte_rle(data):
+    output = bytearray()
+    position = 0
+    literals = bytearray()
+
+    def flush():
+        while literals:
+            chunk = literals[:128]
+            output.append(0x100 - len(chunk))
+            output.extend(chunk)
+            del literals[:128]
+
+    while position < len(data):
+        run = 1
+        while position + run < len(data) and run < 128 and data[position + run] == data[position]:
+            run += 1
+        if run >= 3:
+            flush()
+            output += bytes([run - 1, data[position]])
+        else:
+            literals.extend(data[position:position + run])
+        position += run
+    flush()
+    return bytes(output)
+
+
+def bitmap(rows, bpp, colour=0, compression=epoc.COMPRESSION_NONE):
+    data = pack(rows, bpp)
+    if compression == epoc.COMPRESSION_BYTE_RLE:
+        data = encode_byte_rle(data)
+    return struct.pack("<IIIIIIIIII", 40 + len(data), 40, len(rows[0]), len(rows), 0, 0, bpp, colour, 0,
+                       compression) + data
+
+
+def mbm(bitmaps):
+    data = bytearray(struct.pack("<IIII", epoc.KUidDirectFileStore, epoc.KUidMultiBitmapFileImage, 0, 0))
+    data += bytes(4)
+    offsets = []
+    for bitmap_data in bitmaps:
+        offsets.append(len(data))
+        data += bitmap_data
+    struct.pack_into("<I", data, 16, len(data))
+    data += struct.pack(f"<I{len(offsets)}I", len(offsets), *offsets)
+    return bytes(data)
+
+
+def aif(icons, inline=True):
+    # Each icon is a (bitmap, mask) tuple of encoded bitmaps; the mask immediately follows the bitmap.
+    data = bytearray(struct.pack("<IIII", epoc.KUidDirectFileStore, epoc.KUidAppInfoFile, 0x10000000, 0))
+    data += bytes(4)
+    entries = []
+    for bitmap_data, mask_data in icons:
+        entries.append(struct.pack("<IH", len(data), struct.unpack_from("<I", bitmap_data, 8)[0]))
+        data += bitmap_data + mask_data
+    icon_array = bytes([len(entries) << 1]) + b"".join(entries)
+    if inline:
+        # No captions, followed by the icon array.
+        struct.pack_into("<I", data, 16, len(data))
+        data += bytes([0]) + icon_array
+    else:
+        captions_offset = len(data)
+        data += bytes([0])
+        icons_offset = len(data)
+        data += icon_array
+        struct.pack_into("<I", data, 16, len(data))
+        data += struct.pack("<II", captions_offset, icons_offset)
+    return bytes(data)
+
+
+def grey_pixels(rows, bpp):
+    return [(GREY_VALUES[bpp][pixel],) * 3 for row in rows for pixel in row]
+
+
+class TestDecodeByteRle(unittest.TestCase):
+
+    def test_runs(self):
+        self.assertEqual(epoc.decode_byte_rle(bytes([0x03, 0xaa]), 4), b"\xaa" * 4)
+        self.assertEqual(epoc.decode_byte_rle(bytes([0x7f, 0x01]), 128), b"\x01" * 128)
+
+    def test_literals(self):
+        self.assertEqual(epoc.decode_byte_rle(bytes([0xfd, 0x01, 0x02, 0x03]), 3), b"\x01\x02\x03")
+        self.assertEqual(epoc.decode_byte_rle(bytes([0x80]) + bytes(range(128)), 128), bytes(range(128)))
+
+    def test_mixed(self):
+        data = bytes([0x01, 0xff, 0xfe, 0x10, 0x20, 0x02, 0x00])
+        self.assertEqual(epoc.decode_byte_rle(data, 7), b"\xff\xff\x10\x20\x00\x00\x00")
+
+    def test_truncates_to_size(self):
+        self.assertEqual(epoc.decode_byte_rle(bytes([0x09, 0x11, 0xfe, 0x01, 0x02]), 4), b"\x11" * 4)
+
+    def test_short_input(self):
+        self.assertEqual(epoc.decode_byte_rle(bytes([0x01, 0x11, 0xfd, 0x01]), 8), b"\x11\x11\x01")
+
+    def test_round_trip(self):
+        data = bytes([0] * 300 + list(range(200)) + [7, 7, 8, 8, 8, 9] + [255] * 129)
+        self.assertEqual(epoc.decode_byte_rle(encode_byte_rle(data), len(data)), data)
+
+
+class TestBitmapImage(unittest.TestCase):
+
+    def test_grey(self):
+        # Odd widths exercise the padding of each scan line, and partially filled bytes.
+        for compression in [epoc.COMPRESSION_NONE, epoc.COMPRESSION_BYTE_RLE]:
+            for bpp in [1, 2, 4, 8]:
+                for width, height in [(1, 1), (5, 3), (17, 9), (48, 48)]:
+                    with self.subTest(compression=compression, bpp=bpp, width=width, height=height):
+                        rows = pattern(width, height, bpp)
+                        bitmaps = epoc.read_mbm(mbm([bitmap(rows, bpp, compression=compression)]))
+                        self.assertEqual(len(bitmaps), 1)
+                        self.assertEqual((bitmaps[0].width, bitmaps[0].height, bitmaps[0].bpp), (width, height, bpp))
+                        image = bitmaps[0].image().convert("RGB")
+                        self.assertEqual(list(image.getdata()), grey_pixels(rows, bpp))
+
+    def test_colour(self):
+        rows = [[0, 5, 9, 15, 9], [15, 9, 5, 0, 0]]
+        for compression in [epoc.COMPRESSION_NONE, epoc.COMPRESSION_BYTE_RLE]:
+            with self.subTest(compression=compression):
+                bitmaps = epoc.read_mbm(mbm([bitmap(rows, 4, colour=1, compression=compression)]))
+                image = bitmaps[0].image().convert("RGB")
+                self.assertEqual(list(image.getdata()), [COLOUR_VALUES[pixel] for row in rows for pixel in row])
+
+    def test_multiple(self):
+        first, second = pattern(3, 2, 1), pattern(7, 4, 8)
+        bitmaps = epoc.read_mbm(mbm([bitmap(first, 1), bitmap(second, 8, compression=epoc.COMPRESSION_BYTE_RLE)]))
+        self.assertEqual([list(b.image().convert("RGB").getdata()) for b in bitmaps],
+                         [grey_pixels(first, 1), grey_pixels(second, 8)])
+
+    def test_unsupported(self):
+        with self.assertRaises(epoc.UnsupportedFormat):
+            epoc.read_mbm(mbm([bitmap(pattern(4, 4, 2), 2, colour=1)]))[0].image()
+        with self.assertRaises(epoc.UnsupportedFormat):
+            epoc.read_mbm(mbm([bitmap(pattern(4, 4, 2), 2, compression=3)]))[0].image()
+
+
+class TestReadAifIcons(unittest.TestCase):
+
+    def test_layouts(self):
+        icons = [(bitmap(pattern(16, 16, 4), 4, colour=1), bitmap(pattern(16, 16, 2), 2)),
+                 (bitmap(pattern(24, 24, 2), 2, compression=epoc.COMPRESSION_BYTE_RLE),
+                  bitmap(pattern(24, 24, 2), 2, compression=epoc.COMPRESSION_BYTE_RLE))]
+        for inline in [True, False]:
+            with self.subTest(inline=inline):
+                result = epoc.read_aif_icons(aif(icons, inline=inline))
+                self.assertEqual([(b.width, b.height, b.bpp, m.width, m.height, m.bpp) for b, m in result],
+                                 [(16, 16, 4, 16, 16, 2), (24, 24, 2, 24, 24, 2)])
+
+    def test_not_an_aif(self):
+        with self.assertRaises(epoc.UnsupportedFormat):
+            epoc.read_aif_icons(mbm([bitmap(pattern(4, 4, 2), 2)]))
+
+
+class TestDecodeIcons(unittest.TestCase):
+
+    ICONS = [
+        (pattern(16, 16, 1), 1, 0, epoc.COMPRESSION_NONE, pattern(16, 16, 2)),
+        (pattern(24, 24, 2), 2, 0, epoc.COMPRESSION_BYTE_RLE, pattern(24, 24, 2)),
+        (pattern(32, 32, 4), 4, 1, epoc.COMPRESSION_NONE, pattern(32, 32, 2)),
+        (pattern(48, 48, 8), 8, 0, epoc.COMPRESSION_BYTE_RLE, pattern(48, 48, 2)),
+    ]
+
+    def aif(self):
+        return aif([(bitmap(rows, bpp, colour=colour, compression=compression),
+                     bitmap(mask, 2, compression=compression))
+                    for rows, bpp, colour, compression, mask in self.ICONS])
+
+    def test_masked(self):
+        icons = opolua.decode_icons(self.aif())
+        self.assertEqual(len(icons), len(self.ICONS))
+        for icon, (rows, bpp, colour, _, mask) in zip(icons, self.ICONS):
+            with self.subTest(bpp=bpp):
+                self.assertEqual((icon.width, icon.height, icon.bpp), (len(rows[0]), len(rows), bpp))
+                colours = ([COLOUR_VALUES.get(pixel) for row in rows for pixel in row] if colour
+                           else grey_pixels(rows, bpp))
+                # Only black (zero) mask pixels are opaque.
+                alphas = [255 if value == 0 else 0 for row in mask for value in row]
+                for actual, expected, alpha in zip(icon._source.getdata(), colours, alphas):
+                    if expected is not None:
+                        self.assertEqual(actual[:3], expected)
+                    self.assertEqual(actual[3], alpha)
+
+    def test_unmasked(self):
+        # Masks that aren't 2bpp, or don't match the size of the icon, are ignored.
+        rows = pattern(16, 16, 2)
+        for mask in [bitmap(pattern(16, 16, 1), 1), bitmap(pattern(8, 8, 2), 2)]:
+            icons = opolua.decode_icons(aif([(bitmap(rows, 2), mask)]))
+            self.assertEqual([pixel[3] for pixel in icons[0]._source.getdata()], [255] * 256)
+
+    @unittest.skipUnless(os.path.exists(opolua.DUMPAIF_PATH), "opolua is not available")
+    def test_matches_dumpaif(self):
+        with tempfile.TemporaryDirectory() as directory_path:
+            path = os.path.join(directory_path, "ICONS.AIF")
+            with open(path, "wb") as fh:
+                fh.write(self.aif())
+            decoded = sorted(opolua.decode_icons(self.aif()), key=lambda icon: icon.width)
+            extracted = sorted(opolua.extract_icons(path), key=lambda icon: icon.width)
+        self.assertEqual([(icon.width, icon.height, icon.bpp) for icon in decoded],
+                         [(icon.width, icon.height, icon.bpp) for icon in extracted])
+        for icon, reference in zip(decoded, extracted):
+            with self.subTest(bpp=icon.bpp):
+                self.assertEqual(list(icon._source.getdata()), list(reference._source.getdata()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,103 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import tempfile
+import unittest
+import unittest.mock
+
+import opolua
+
+
+# Stand-in for `recognize.lua`, using the same conventions: it loads a helper relative to `arg[0]`, reports its result
+# on stdout, and fails with `os.exit` or by raising an error.
+RECOGNIZE_SOURCE = """
+dofile(arg[0]:sub(1, arg[0]:match("/?()[^/]+$") - 1) .. "helpers.lua")
+local data = readFile(arg[2])
+if data == "exit" then
+    print("Not a recognized file")
+    os.exit(1)
+elseif data == "error" then
+    error("Unable to recognize file")
+elseif data == "write" then
+    io.stdout:write('{"type": "app", ')
+    io.write('"era": "er5"}\\n')
+    os.exit(0)
+end
+print('{"type": "' .. data .. '"}')
+"""
+
+HELPERS_SOURCE = """
+function readFile(path)
+    local f = assert(io.open(path, "rb"))
+    local data = f:read("a")
+    f:close()
+    return data
+end
+"""
+
+
+class TestRecognizeFiles(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.recognize_path = self.write("recognize.lua", RECOGNIZE_SOURCE)
+        self.write("helpers.lua", HELPERS_SOURCE)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def write(self, name, contents):
+        path = os.path.join(self.directory.name, name)
+        with open(path, "w") as fh:
+            fh.write(contents)
+        return path
+
+    def test_batch(self):
+        paths = [self.write(f"{index}.bin", contents)
+                 for index, contents in enumerate(["opo", "exit", "error", "write", "aif"])]
+        with unittest.mock.patch.object(opolua, "RECOGNIZE_PATH", self.recognize_path):
+            self.assertEqual(opolua.recognize_files(paths),
+                             [{"type": "opo"},
+                              {"type": "unknown"},
+                              {"type": "unknown"},
+                              {"type": "app", "era": "er5"},
+                              {"type": "aif"}])
+
+    def test_matches_recognize(self):
+        paths = [self.write(f"{index}.bin", contents) for index, contents in enumerate(["opo", "exit", "write"])]
+        with unittest.mock.patch.object(opolua, "RECOGNIZE_PATH", self.recognize_path):
+            self.assertEqual(opolua.recognize_files(paths), [opolua.recognize(path) for path in paths])
+
+    def test_fallback(self):
+        paths = [self.write("0.bin", "opo"), self.write("1.bin", "aif")]
+        missing_path = os.path.join(self.directory.name, "missing.lua")
+        with unittest.mock.patch.object(opolua, "RECOGNIZE_PATH", self.recognize_path), \
+                unittest.mock.patch.object(opolua, "RECOGNIZE_BATCH_PATH", missing_path):
+            with self.assertLogs(level="WARNING"):
+                self.assertEqual(opolua.recognize_all(paths), [{"type": "opo"}, {"type": "aif"}])
+
+    def test_empty(self):
+        self.assertEqual(opolua.recognize_all([]), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,171 @@
+# Copyright (c) 2024 Jason Morley
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import http.server
+import json
+import os
+import re
+import tempfile
+import threading
+import unittest
+
+import utils
+
+
+class Server(object):
+    """
+    Local HTTP server serving `data` at every path, optionally supporting range requests, and optionally failing any
+    range request that doesn't start at the beginning of the file (i.e., everything but the mirror probe).
+    """
+
+    def __init__(self, data, supports_ranges=True, fail_segments=False):
+        self.data = data
+        self.supports_ranges = supports_ranges
+        self.fail_segments = fail_segments
+        self.ranges = []
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                match = re.match(r"^bytes=(\d+)-(\d+)$", self.headers.get("Range", ""))
+                if match and server.supports_ranges:
+                    start, end = int(match.group(1)), min(int(match.group(2)), len(server.data) - 1)
+                    server.ranges.append((start, end))
+                    if server.fail_segments and start != 0:
+                        self.send_error(503)
+                        return
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(server.data)}")
+                    body = server.data[start:end + 1]
+                else:
+                    self.send_response(200)
+                    body = server.data
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}/file.bin"
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class TestDownload(unittest.TestCase):
+
+    def setUp(self):
+        self._segment_size = utils.SEGMENT_SIZE
+        self._probe_size = utils.PROBE_SIZE
+        utils.SEGMENT_SIZE = 64 * 1024
+        utils.PROBE_SIZE = 1024
+        self.data = os.urandom(10 * utils.SEGMENT_SIZE + 123)
+        self._directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self._directory.name, "file.bin")
+
+    def tearDown(self):
+        utils.SEGMENT_SIZE = self._segment_size
+        utils.PROBE_SIZE = self._probe_size
+        self._directory.cleanup()
+
+    def read(self):
+        with open(self.path, "rb") as fh:
+            return fh.read()
+
+    def test_segmented(self):
+        with Server(self.data) as first, Server(self.data) as second:
+            utils.download_file_with_mirrors([first.url, second.url], self.path)
+        self.assertEqual(self.read(), self.data)
+        self.assertFalse(os.path.exists(self.path + ".part"))
+        self.assertFalse(os.path.exists(self.path + ".part.json"))
+
+    def test_resume(self):
+        # Simulate an interrupted download with the first half of the segments complete, and the next one partially
+        # complete.
+        state = utils.DownloadState.create(self.path + ".part.json", len(self.data))
+        with open(self.path + ".part", "wb") as fh:
+            fh.truncate(len(self.data))
+            for segment in state.segments[:5]:
+                fh.seek(segment.start)
+                fh.write(self.data[segment.start:segment.end + 1])
+                segment.position = segment.end + 1
+            partial = state.segments[5]
+            fh.seek(partial.start)
+            fh.write(self.data[partial.start:partial.start + 100])
+            partial.position = partial.start + 100
+        state.save(force=True)
+        with open(self.path + ".part.json") as fh:
+            self.assertEqual(json.load(fh)["size"], len(self.data))
+
+        with Server(self.data) as server:
+            utils.download_file_with_mirrors([server.url], self.path)
+            requested = [start for start, _ in server.ranges if start != 0]
+        self.assertEqual(self.read(), self.data)
+        self.assertEqual(sorted(requested), [partial.start + 100] + [segment.start for segment in state.segments[6:]])
+
+    def test_resume_ignores_mismatched_state(self):
+        state = utils.DownloadState.create(self.path + ".part.json", len(self.data) + 1)
+        state.save(force=True)
+        with open(self.path + ".part", "wb") as fh:
+            fh.write(b"\xff" * 1024)
+        with Server(self.data) as server:
+            utils.download_file_with_mirrors([server.url], self.path)
+        self.assertEqual(self.read(), self.data)
+
+    def test_failed_mirror_segments_requeued(self):
+        with Server(self.data, fail_segments=True) as failing, Server(self.data) as working:
+            # Make sure the failing mirror is preferred, so that it's given segments.
+            utils.THROUGHPUT.clear()
+            utils.record_throughput("127.0.0.1:%d" % failing._server.server_address[1], 1 << 40, 1)
+            utils.download_file_with_mirrors([failing.url, working.url], self.path)
+            failed = [start for start, _ in failing.ranges if start != 0]
+        self.assertEqual(self.read(), self.data)
+        self.assertGreater(len(failed), 0)
+        self.assertLessEqual(len(failed), utils.MAXIMUM_MIRROR_FAILURES + utils.MAXIMUM_CONNECTIONS)
+
+    def test_all_mirrors_failing(self):
+        with Server(self.data, fail_segments=True) as failing:
+            with self.assertRaises(Exception):
+                utils.download_file_with_mirrors([failing.url], self.path)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertTrue(os.path.exists(self.path + ".part.json"))
+
+    def test_no_range_support(self):
+        with Server(self.data, supports_ranges=False) as server:
+            utils.download_file_with_mirrors([server.url], self.path)
+            self.assertEqual(server.ranges, [])
+        self.assertEqual(self.read(), self.data)
+        self.assertFalse(os.path.exists(self.path + ".part"))
+
+
+if __name__ == "__main__":
+    unittest.main()
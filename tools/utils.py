@@ -20,45 +20,444 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import concurrent.futures
+import json
 import logging
 import os
+import queue
 import requests
-import shutil
-import tempfile
+import threading
+import time
+
+from urllib.parse import urlparse
 
 from tqdm import tqdm
 
 
-def download_file_with_mirrors(urls, local_filename=None):
+CHUNK_SIZE = 1024 * 1024
+SEGMENT_SIZE = 16 * 1024 * 1024
+PROBE_SIZE = 256 * 1024
+MAXIMUM_CONNECTIONS = 4
+MAXIMUM_MIRROR_FAILURES = 3
+STATE_SAVE_INTERVAL = 1.0
+TIMEOUT = (10, 60)
+
+# Throughput (bytes per second) observed for each mirror host during this run; used to rank mirrors and to decide
+# which mirror should serve the next segment of a download.
+THROUGHPUT = {}
+THROUGHPUT_LOCK = threading.Lock()
+THROUGHPUT_SMOOTHING = 0.3
+
+
+class IncompleteDownload(Exception):
+    pass
+
+
+class RangeNotSupported(Exception):
+    pass
+
+
+class Validators(object):
+    """
+    HTTP cache validators (`ETag` and `Last-Modified`) for the files fetched into a directory, along with the URL they
+    were served from and when they were last revalidated, allowing unchanged files to be revalidated with a conditional
+    request rather than downloaded again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(path) as fh:
+                self._entries = json.load(fh)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def name_for(self, path):
+        return os.path.relpath(path, os.path.dirname(self.path))
+
+    def get(self, name):
+        return self._entries.get(name)
+
+    def is_due(self, name, interval):
+        entry = self._entries.get(name)
+        return entry is None or time.time() - entry.get("checked", 0) >= interval
+
+    def set(self, name, url, headers):
+        self._entries[name] = {
+            "url": url,
+            "etag": headers.get("etag"),
+            "last_modified": headers.get("last-modified"),
+            "checked": time.time(),
+        }
+        self.save()
+
+    def touch(self, name):
+        self._entries[name]["checked"] = time.time()
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temporary_path = self.path + ".tmp"
+        with open(temporary_path, "w") as fh:
+            json.dump(self._entries, fh, indent=4, sort_keys=True)
+        os.replace(temporary_path, self.path)
+
+
+def conditional_headers(entry):
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def record_throughput(netloc, byte_count, duration):
+    if byte_count <= 0:
+        return
+    sample = byte_count / max(duration, 0.001)
+    with THROUGHPUT_LOCK:
+        if netloc in THROUGHPUT:
+            THROUGHPUT[netloc] = (1 - THROUGHPUT_SMOOTHING) * THROUGHPUT[netloc] + THROUGHPUT_SMOOTHING * sample
+        else:
+            THROUGHPUT[netloc] = sample
+
+
+def throughput_for(netloc):
+    with THROUGHPUT_LOCK:
+        return THROUGHPUT.get(netloc, 0.0)
+
+
+class Mirror(object):
+
+    def __init__(self, url):
+        self.url = url
+        self.netloc = urlparse(url).netloc
+        self.size = None
+        self.supports_ranges = False
+        self.error = None
+        self.failures = 0
+        self.connections = 0
+        self.headers = {}
+
+    @property
+    def is_available(self):
+        return self.error is None and self.failures < MAXIMUM_MIRROR_FAILURES
+
+    def probe(self):
+        # Fetch the head of the file with a range request; this tells us whether the mirror supports ranges, the size
+        # of the file, and gives us a first throughput measurement with which to race the mirrors against each other.
+        try:
+            start_time = time.monotonic()
+            with requests.get(self.url,
+                              headers={"Range": f"bytes=0-{PROBE_SIZE - 1}"},
+                              stream=True,
+                              timeout=TIMEOUT) as response:
+                response.raise_for_status()
+                self.headers = response.headers
+                if response.status_code == 206:
+                    self.supports_ranges = True
+                    content_range = response.headers.get("content-range", "")
+                    total = content_range.rsplit("/", 1)[-1]
+                    self.size = int(total) if total.isdigit() else None
+                elif "content-length" in response.headers:
+                    self.size = int(response.headers["content-length"])
+                byte_count = 0
+                for data in response.iter_content(chunk_size=CHUNK_SIZE):
+                    byte_count += len(data)
+                    if byte_count >= PROBE_SIZE:
+                        break
+            record_throughput(self.netloc, byte_count, time.monotonic() - start_time)
+        except requests.exceptions.RequestException as e:
+            logging.warning("Mirror '%s' unavailable with error '%s'.", self.url, e)
+            self.error = e
+        return self
+
+
+class Segment(object):
+
+    def __init__(self, start, end, position=None):
+        self.start = start
+        self.end = end  # Inclusive.
+        self.position = position if position is not None else start
+
+    @property
+    def remaining(self):
+        return self.end + 1 - self.position
+
+    def as_list(self):
+        return [self.start, self.end, self.position]
+
+
+class DownloadState(object):
+    """
+    Progress of a segmented download, persisted alongside the `.part` file so that interrupted downloads can resume.
+    """
+
+    def __init__(self, path, size, segments):
+        self.path = path
+        self.size = size
+        self.segments = segments
+        self._lock = threading.Lock()
+        self._last_save = 0
+
+    @classmethod
+    def create(cls, path, size):
+        segments = [Segment(start, min(start + SEGMENT_SIZE, size) - 1)
+                    for start in range(0, size, SEGMENT_SIZE)]
+        return cls(path, size, segments)
+
+    @classmethod
+    def load(cls, path, size):
+        try:
+            with open(path) as fh:
+                contents = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if contents.get("size") != size:
+            return None
+        return cls(path, size, [Segment(*segment) for segment in contents["segments"]])
+
+    @property
+    def completed(self):
+        return sum(segment.position - segment.start for segment in self.segments)
+
+    def save(self, force=False):
+        with self._lock:
+            now = time.monotonic()
+            if not force and now - self._last_save < STATE_SAVE_INTERVAL:
+                return
+            self._last_save = now
+            temporary_path = self.path + ".tmp"
+            with open(temporary_path, "w") as fh:
+                json.dump({
+                    "size": self.size,
+                    "segments": [segment.as_list() for segment in self.segments],
+                }, fh)
+            os.replace(temporary_path, self.path)
+
+
+def download_segment(session, mirror, segment, fd, state, progress_bar):
+    start_time = time.monotonic()
+    start_position = segment.position
+    with session.get(mirror.url,
+                     headers={"Range": f"bytes={segment.position}-{segment.end}"},
+                     stream=True,
+                     timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangeNotSupported(mirror.url)
+        for data in response.iter_content(chunk_size=CHUNK_SIZE):
+            data = data[:segment.remaining]
+            os.pwrite(fd, data, segment.position)
+            segment.position += len(data)
+            progress_bar.update(len(data))
+            state.save()
+            if segment.remaining <= 0:
+                break
+    record_throughput(mirror.netloc, segment.position - start_position, time.monotonic() - start_time)
+    if segment.remaining > 0:
+        raise IncompleteDownload(mirror.url)
+
+
+def download_segments(mirrors, size, local_filename, connections):
+    part_path = local_filename + ".part"
+    state_path = local_filename + ".part.json"
+
+    state = DownloadState.load(state_path, size) if os.path.exists(part_path) else None
+    if state is None:
+        state = DownloadState.create(state_path, size)
+        with open(part_path, "wb") as fh:
+            fh.truncate(size)
+    else:
+        logging.info("Resuming download with %d of %d bytes complete...", state.completed, size)
+
+    pending = queue.Queue()
+    for segment in state.segments:
+        if segment.remaining > 0:
+            pending.put(segment)
+
+    lock = threading.Lock()
+    errors = []
+
+    def select_mirror():
+        # Spread connections over the mirrors in proportion to their measured throughput.
+        with lock:
+            candidates = [mirror for mirror in mirrors if mirror.is_available]
+            if not candidates:
+                return None
+            mirror = max(candidates, key=lambda x: throughput_for(x.netloc) / (x.connections + 1))
+            mirror.connections += 1
+            return mirror
+
+    def worker(progress_bar):
+        with requests.Session() as session:
+            while True:
+                try:
+                    segment = pending.get_nowait()
+                except queue.Empty:
+                    return
+                mirror = select_mirror()
+                if mirror is None:
+                    pending.put(segment)
+                    return
+                try:
+                    download_segment(session, mirror, segment, fd, state, progress_bar)
+                except (requests.exceptions.RequestException, RangeNotSupported, IncompleteDownload) as e:
+                    logging.warning("Failed to download segment from '%s' with error '%s'.", mirror.url, e)
+                    with lock:
+                        mirror.failures += 1
+                        errors.append(e)
+                    pending.put(segment)
+                finally:
+                    with lock:
+                        mirror.connections -= 1
+
+    fd = os.open(part_path, os.O_RDWR)
+    try:
+        with tqdm(total=size, initial=state.completed, unit="B", unit_scale=True) as progress_bar:
+            worker_count = max(1, min(connections, pending.qsize()))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=worker_count) as executor:
+                futures = [executor.submit(worker, progress_bar) for _ in range(worker_count)]
+                for future in concurrent.futures.as_completed(futures):
+                    future.result()
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+        state.save(force=True)
+
+    if any(segment.remaining > 0 for segment in state.segments):
+        if errors:
+            raise errors[-1]
+        raise IncompleteDownload(local_filename)
+
+    os.replace(part_path, local_filename)
+    os.remove(state_path)
+
+
+def download_stream(mirror, local_filename):
+    # Fallback for mirrors that don't support range requests; the download always starts from scratch.
+    part_path = local_filename + ".part"
+    with requests.get(mirror.url, stream=True, timeout=TIMEOUT) as response:
+        response.raise_for_status()
+        total_size = int(response.headers.get("content-length", 0))
+        start_time = time.monotonic()
+        with tqdm(total=total_size, unit="B", unit_scale=True) as progress_bar:
+            with open(part_path, "wb") as fh:
+                for data in response.iter_content(chunk_size=CHUNK_SIZE):
+                    progress_bar.update(len(data))
+                    fh.write(data)
+        record_throughput(mirror.netloc, progress_bar.n, time.monotonic() - start_time)
+    os.replace(part_path, local_filename)
+
+
+def download_file_with_mirrors(urls, local_filename=None, connections=MAXIMUM_CONNECTIONS, validators=None):
+    """
+    Download `local_filename` from the fastest of `urls`. If `validators` is given, the `ETag` and `Last-Modified` of
+    the downloaded file are recorded in it for later revalidation with `is_modified`.
+    """
     urls = list(urls)
-    while True:
-        url = urls.pop(0)
+    local_filename = local_filename if local_filename is not None else urls[0].split('/')[-1]
+    logging.info("Downloading '%s'...", urls[0])
+
+    # Race the mirrors against each other and rank the ones that respond by their measured throughput.
+    mirrors = [Mirror(url) for url in urls]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(mirrors)) as executor:
+        list(executor.map(lambda mirror: mirror.probe(), mirrors))
+    available = sorted([mirror for mirror in mirrors if mirror.is_available],
+                       key=lambda x: throughput_for(x.netloc),
+                       reverse=True)
+    if not available:
+        raise mirrors[0].error
+
+    # Only use mirrors that agree on the size of the file.
+    size = available[0].size
+    for mirror in available:
+        if mirror.size != size:
+            logging.warning("Ignoring mirror '%s' with mismatched size %s (expected %s).", mirror.url, mirror.size, size)
+    available = [mirror for mirror in available if mirror.size == size]
+
+    # Validators are recorded against a single mirror since ETags generally differ between hosts.
+    def record_validators(mirror):
+        if validators is not None:
+            validators.set(validators.name_for(local_filename), mirror.url, mirror.headers)
+
+    ranged = [mirror for mirror in available if mirror.supports_ranges]
+    if size is not None and ranged:
+        download_segments(ranged, size, local_filename, connections=connections)
+        record_validators(ranged[0])
+        return local_filename
+
+    error = None
+    for mirror in available:
+        try:
+            download_stream(mirror, local_filename)
+            record_validators(mirror)
+            return local_filename
+        except requests.exceptions.RequestException as e:
+            logging.warning("Failed to download '%s' with error '%s'.", mirror.url, e)
+            error = e
+    raise error
+
+
+def fetch_file(urls, local_filename, validators):
+    """
+    Fetch a small file, such as an item's metadata, with a conditional request against the validators recorded for it,
+    trying each of `urls` in turn. Returns `True` if the file was (re)downloaded, and `False` if the server reported it
+    unchanged, or if it couldn't be revalidated and there's a previously downloaded copy to fall back on.
+    """
+    name = validators.name_for(local_filename)
+    entry = validators.get(name) if os.path.exists(local_filename) else None
+    error = None
+    for url in urls:
+        # Validators are only meaningful to the host that issued them.
+        headers = conditional_headers(entry) if entry is not None and entry["url"] == url else {}
         try:
-            return download_file(url, local_filename)
-        except requests.exceptions.HTTPError as e:
-            if e.response.status_code != 503 or len(urls) < 1:
-                raise
-            continue
-        except requests.exceptions.ConnectTimeout:
-            if len(urls) < 1:
-                raise
-            continue
+            with requests.get(url, headers=headers, timeout=TIMEOUT) as response:
+                response.raise_for_status()
+                if response.status_code == 304:
+                    logging.debug("'%s' not modified.", url)
+                    validators.touch(name)
+                    return False
+                logging.info("Downloading '%s'...", url)
+                temporary_path = local_filename + ".tmp"
+                with open(temporary_path, "wb") as fh:
+                    fh.write(response.content)
+                os.replace(temporary_path, local_filename)
+                validators.set(name, url, response.headers)
+                return True
+        except requests.exceptions.RequestException as e:
+            logging.warning("Failed to fetch '%s' with error '%s'.", url, e)
+            error = e
+    if os.path.exists(local_filename):
+        logging.warning("Unable to revalidate '%s'; using the existing copy.", local_filename)
+        return False
+    raise error
+
+
+def is_modified(local_filename, validators):
+    """
+    Revalidate a previously downloaded file with a conditional request to the URL it was downloaded from, without
+    fetching its contents. Files without validators, or that can't be revalidated, are assumed to be unchanged.
+    """
+    name = validators.name_for(local_filename)
+    entry = validators.get(name)
+    headers = conditional_headers(entry)
+    if not headers:
+        return False
+    try:
+        with requests.get(entry["url"], headers=headers, stream=True, timeout=TIMEOUT) as response:
+            response.raise_for_status()
+            if response.status_code == 304:
+                validators.touch(name)
+                return False
+    except requests.exceptions.RequestException as e:
+        logging.warning("Failed to revalidate '%s' with error '%s'.", entry["url"], e)
+        return False
+    return True
 
 
 def download_file(url, local_filename=None):
-    logging.info("Downloading '%s'...", url)
-    local_filename = local_filename if local_filename is not None else url.split('/')[-1]
-    basename = os.path.basename(local_filename)
-    with requests.get(url, stream=True) as response:
-        response.raise_for_status()
-        with tempfile.TemporaryDirectory() as temporary_directory:
-            temporary_path = os.path.join(temporary_directory, basename)
-            total_size = int(response.headers.get("content-length", 0))
-            with tqdm(total=total_size, unit="B", unit_scale=True) as progress_bar:
-                with open(temporary_path, 'wb') as fh:
-                    for data in response.iter_content(chunk_size=1024 * 1024):
-                        progress_bar.update(len(data))
-                        fh.write(data)
-                shutil.move(temporary_path, local_filename)
-
-    return local_filename
+    return download_file_with_mirrors([url], local_filename)